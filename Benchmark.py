@@ -0,0 +1,297 @@
+# Code to benchmark the sensory neuron models on synthetic fibers: node placement, construction, initialization and runs of single fibers against a stored baseline, startup of sweep workers, build time of growing populations, and multithreaded integration of a fiber population
+
+from __future__ import division
+from neuron_runtime import h, load_mechanisms, neuron_version
+from numpy import array,c_,linspace,sin,zeros
+from Cell import ABetaFiber, ADeltaFiber
+from fiber_parameters import MRG_DIAMETERS
+from find_node_coordinates import find_devor_node_coordinates
+from Population import FiberPopulation
+from Simulation import _init_worker, _run_jobs, rectangular_pulse, simulate
+
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+FIBER_CLASSES = {'ABeta': (ABetaFiber, 'ABetaFiber.hoc'), 'ADelta': (ADeltaFiber, 'ADeltaFiber_LTMR.hoc')}
+
+# results are matched with the baseline on these fields
+KEY = ('phase', 'fiber_type', 'fiberD', 'variable_STIN', 'length', 'points')
+
+def synthetic_trajectory(length, points, direction=1, bend=1e-3):
+    '''
+    Gently curving axon trajectory starting at the T-junction (the origin) and running along x
+    length, bend: m
+    direction: 1 for a peripheral, -1 for a dorsal root (central) axon
+    returns a (points,3) array (m)
+    '''
+    s = linspace(0, length, points)
+    return c_[direction*s, bend*sin(s/5e-3), zeros(points)]
+
+def synthetic_stem(length=0.7e-3, points=4):
+    '''
+    Straight stem trajectory from the T-junction (the origin) to the soma, along y
+    '''
+    return c_[zeros(points), linspace(0, length, points), zeros(points)]
+
+def synthetic_population(fiber_types, diameters, lengths, CELL_DIR, points_per_mm=50, **kwargs):
+    '''
+    FiberPopulation of synthetic fibers, one per entry of fiber_types ('ABeta' or 'ADelta'), diameters (um) and
+    lengths (m) of the peripheral axon; the central axon is half as long
+    kwargs: passed on to FiberPopulation
+    '''
+    return FiberPopulation(peripheral_trajectories=[synthetic_trajectory(length, int(length*1e3*points_per_mm)) for length in lengths],
+                           dorsal_trajectories=[synthetic_trajectory(length/2, int(length*1e3*points_per_mm/2), -1) for length in lengths],
+                           stem_trajectories=[synthetic_stem() for length in lengths], fiberD_central=list(diameters),
+                           fiberD_peripheral=list(diameters), fiberD_stem=list(diameters), pain=False, fiber_type=list(fiber_types),
+                           CELL_DIR=CELL_DIR, interpolate_diameter=True, **kwargs)
+
+def best_time(function, repeats=3):
+    '''
+    Shortest wall time (s) of repeats calls of function(), and the result of the last one
+    '''
+    times = []
+    for ii in range(repeats):
+        t0 = time.time()
+        result = function()
+        times.append(time.time() - t0)
+    return min(times), result
+
+def node_placement(points=(1000, 4000, 16000, 64000), length=100e-3, fiberD=10.0, repeats=3):
+    '''
+    find_devor_node_coordinates on peripheral trajectories of increasing point count
+    returns one result per trajectory
+    '''
+    results = []
+    for numPoints in points:
+        trajectory = synthetic_trajectory(length, numPoints)
+        elapsed, (nodes, dx) = best_time(lambda: find_devor_node_coordinates(trajectory, 'peripheral', 'hybrid', fiberD), repeats)
+        results.append({'phase': 'node_placement', 'fiberD': fiberD, 'length': length, 'points': numPoints, 'nodes': len(nodes), 'time': elapsed})
+    return results
+
+def fiber_phases(fiber_type, fiberD, length, CELL_DIR, variable_STIN=False, points_per_mm=50, tstop=5, dt=0.005):
+    '''
+    Construction (the fiber class, i.e. _construct_cell), finitialize and a standard pulse run (0.1 ms, 1 mA cathodic,
+    1 mm from the peripheral axon) of one synthetic fiber with a peripheral axon of length (m)
+    returns one result per phase
+    '''
+    fiber_class, CELL_FILE_NAME = FIBER_CLASSES[fiber_type]
+    arguments = dict(peripheral_trajectory=synthetic_trajectory(length, int(length*1e3*points_per_mm)),
+                     dorsal_trajectory=synthetic_trajectory(length/2, int(length*1e3*points_per_mm/2), -1), stem_trajectory=synthetic_stem(),
+                     fiberD_central=fiberD, fiberD_peripheral=fiberD, fiberD_stem=fiberD, pain=False, variable_STIN=variable_STIN,
+                     CELL_DIR=CELL_DIR, CELL_FILE_NAME=CELL_FILE_NAME)
+    key = {'fiber_type': fiber_type, 'fiberD': fiberD, 'variable_STIN': bool(variable_STIN), 'length': length}
+    try:
+        t0 = time.time()
+        cell = fiber_class(**arguments)
+        construct = time.time() - t0
+    except Exception as error:
+        return [dict(key, phase='construct', error=repr(error))]
+    size = {'nodes': cell.axonnodesP + cell.axonnodesC + cell.axonnodesT, 'sections': len(cell.get_secs())}
+
+    h.dt = dt
+    initialize, result = best_time(cell.initialize)
+    t0 = time.time()
+    simulate(cell, -1.0, 0.1, (length/2, 1e-3, 0), tstop=tstop, dt=dt)
+    run = time.time() - t0
+    del cell
+    gc.collect() # the fiber and its stimulus refer to each other
+    return [dict(key, phase=phase, time=elapsed, **size) for phase, elapsed in (('construct', construct), ('initialize', initialize), ('run', run))]
+
+def suite(CELL_DIR, diameters=MRG_DIAMETERS, lengths=(10e-3, 20e-3, 40e-3, 80e-3), quick=False):
+    '''
+    The whole benchmark: node placement, then construction, initialization and a run of both fiber classes with and
+    without variable_STIN, for every diameter at the shortest length and for every length at 10 um (ABeta) and 3 um
+    (ADelta). quick: only the first two diameters and lengths
+    returns a list of results, each a dictionary with the fields of KEY that apply, the time (s) and the size
+    '''
+    if quick:
+        diameters, lengths = diameters[:2], lengths[:2]
+    results = node_placement(points=(1000, 4000) if quick else (1000, 4000, 16000, 64000))
+    for fiber_type, scalingD in (('ABeta', 10.0), ('ADelta', 3.0)):
+        for variable_STIN in (False, True):
+            for fiberD in diameters:
+                results.extend(fiber_phases(fiber_type, fiberD, lengths[0], CELL_DIR, variable_STIN))
+            for length in lengths[1:]:
+                results.extend(fiber_phases(fiber_type, scalingD, length, CELL_DIR, variable_STIN))
+    return results
+
+def compare(results, baseline, tolerance=0.25, minimum=0.01):
+    '''
+    Regressions of results against a baseline run of the suite: results taking more than (1+tolerance) times as
+    long as the baseline result with the same KEY fields. Results faster than minimum (s) in both are not compared.
+    returns a list of (result, baseline time)
+    '''
+    reference = dict((tuple(result.get(name) for name in KEY), result['time']) for result in baseline if 'time' in result)
+    regressions = []
+    for result in results:
+        previous = reference.get(tuple(result.get(name) for name in KEY))
+        if ('time' not in result) or (previous is None) or (max(result['time'], previous) < minimum):
+            continue
+        if result['time'] > (1+tolerance)*previous:
+            regressions.append((result, previous))
+    return regressions
+
+def import_time(module='Cell'):
+    '''
+    Time (s) to import module in a fresh Python interpreter, run from this directory
+    '''
+    code = 'import time; t0 = time.time(); import %s; print(time.time() - t0)' % module
+    return float(subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__))).split()[-1])
+
+def worker_startup(fiber, mechanism_dir=None, warm=True, repeats=3):
+    '''
+    Latency of a freshly spawned sweep worker (see Simulation.run_sweep), cold (warm=False: NEURON, the standard run
+    library and the template are loaded by its first job) or warm (loaded by its initializer)
+    fiber: fiber specification, see Simulation.build_fiber
+    returns the best time (s) of repeats workers until the worker is up, and of its first and second job (building
+    the fiber and a 0.1 ms pulse, then only the pulse)
+    '''
+    startup, firstJob, secondJob = [], [], []
+    electrode = (float(fiber['peripheral_trajectory'][-1][0])/2, 1e-3, 0)
+    context = multiprocessing.get_context('spawn')
+    for ii in range(repeats):
+        results = context.Queue()
+        t0 = time.time()
+        with ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=_init_worker,
+                                 initargs=([fiber], mechanism_dir, None, warm, results)) as pool:
+            pool.submit(os.getpid).result()
+            startup.append(time.time() - t0)
+            for times in (firstJob, secondJob):
+                t0 = time.time()
+                pool.submit(_run_jobs, 0, [(-1.0, 0.1, electrode)], {}).result()
+                results.get()
+                times.append(time.time() - t0)
+    return {'warm': warm, 'startup': min(startup), 'first_job': min(firstJob), 'second_job': min(secondJob)}
+
+def build_scaling(numFibers, CELL_DIR, blocks=4, length=20e-3, fiber_type='ABeta', fiberD=10.0, **kwargs):
+    '''
+    Build time per fiber as a population grows: numFibers identical synthetic fibers built into one process (see
+    FiberPopulation.build_time), split into blocks in build order. Building a fiber must not touch the fibers built
+    before it, so the last block should take as long per fiber as the first.
+    kwargs: passed on to FiberPopulation
+    returns the mean build time (s) per fiber of every block and the growth, the last block over the first
+    '''
+    population = synthetic_population([fiber_type]*numFibers, [fiberD]*numFibers, [length]*numFibers, CELL_DIR, **kwargs)
+    size = max(1, numFibers//blocks)
+    perFiber = [float(population.build_time[ii:ii+size].mean()) for ii in range(0, size*blocks, size) if ii < numFibers]
+    return {'fibers': numFibers, 'per_fiber': perFiber, 'growth': perFiber[-1]/perFiber[0]}
+
+def current_clamps(population, amplitude=2., duration=0.1, delay=0.1):
+    '''
+    One current clamp (nA) at the peripheral end of every fiber of population, the stimulus of a population without
+    any extracellular compartment, where a point source cannot act
+    returns the IClamps, which only stimulate as long as they are kept
+    '''
+    clamps = []
+    for fiber in population:
+        clamp = h.IClamp(fiber.endP(0.5))
+        clamp.delay, clamp.dur, clamp.amp = delay, duration, amplitude
+        clamps.append(clamp)
+    return clamps
+
+def thread_scaling(population, threads, tstop=5, dt=0.005, repeats=1):
+    '''
+    Wall time of running a population (see FiberPopulation.run) on every number of threads in threads, after
+    whatever stimulus was applied to it
+    returns one dictionary per number of threads with the best time (s) of repeats runs, the speedup over the first
+    entry and the segments per thread, or the error if NEURON refused that many threads
+    '''
+    results = []
+    for numThreads in threads:
+        try:
+            load = population.set_threads(numThreads)
+        except ValueError as error:
+            results.append({'threads': numThreads, 'error': str(error)})
+            continue
+        times = []
+        for ii in range(repeats):
+            t0 = time.time()
+            population.run(tstop, dt)
+            times.append(time.time() - t0)
+        results.append({'threads': numThreads, 'time': min(times), 'load': load.tolist()})
+    reference = [result['time'] for result in results if 'time' in result]
+    for result in results:
+        if 'time' in result:
+            result['speedup'] = reference[0]/result['time']
+    population.set_threads(1)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the sensory neuron models on synthetic fibers')
+    parser.add_argument('--mechanisms', help='directory of the compiled mechanisms (nrnivmodl)')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    parser_suite = subparsers.add_parser('suite', help='node placement, construction, initialization and runs against a baseline')
+    parser_suite.add_argument('--output', default='benchmark_results.json', help='where to write the results')
+    parser_suite.add_argument('--baseline', default='benchmark_baseline.json', help='results to compare against')
+    parser_suite.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser_suite.add_argument('--tolerance', type=float, default=0.25, help='relative slowdown reported as a regression')
+    parser_suite.add_argument('--quick', action='store_true', help='only a few diameters and lengths')
+    parser_startup = subparsers.add_parser('startup', help='import time of Cell.py and latency of cold and warm sweep workers')
+    parser_startup.add_argument('--repeats', type=int, default=3, help='workers started per measurement')
+    parser_build = subparsers.add_parser('build', help='build time per fiber as a population grows')
+    parser_build.add_argument('--fibers', type=int, default=200, help='fibers built into one process')
+    parser_build.add_argument('--tolerance', type=float, default=0.5, help='relative growth reported as a regression')
+    parser_threads = subparsers.add_parser('threads', help='run time of a population from 1 to N threads')
+    parser_threads.add_argument('--threads', type=int, default=os.cpu_count(), help='largest number of threads')
+    parser_threads.add_argument('--fibers', type=int, default=8, help='fibers of the mixed ABeta/ADelta population')
+    parser_threads.add_argument('--extracellular-distance', type=float, default=0., help='m around the electrode with the extracellular mechanism; NEURON 9 runs on one thread only if any compartment has it')
+    arguments = parser.parse_args()
+
+    CELL_DIR = os.path.dirname(os.path.abspath(__file__))+'/'
+    if arguments.benchmark == 'startup':
+        print(json.dumps({'import_Cell': import_time('Cell')}))
+        fiber = dict(peripheral_trajectory=synthetic_trajectory(20e-3, 1000), dorsal_trajectory=synthetic_trajectory(10e-3, 500, -1),
+                     stem_trajectory=synthetic_stem(), fiberD_central=10.0, fiberD_peripheral=10.0, fiberD_stem=10.0, pain=False,
+                     CELL_DIR=CELL_DIR, CELL_FILE_NAME='ABetaFiber.hoc', fiber_type='ABeta')
+        for warm in (False, True):
+            print(json.dumps(worker_startup(fiber, arguments.mechanisms, warm, arguments.repeats)))
+        sys.exit(0)
+    if arguments.benchmark == 'build':
+        result = build_scaling(arguments.fibers, CELL_DIR, **({'MECHANISM_DIR': arguments.mechanisms} if arguments.mechanisms else {}))
+        print(json.dumps(result))
+        if result['growth'] > 1 + arguments.tolerance:
+            print('REGRESSION build time per fiber grows %.2f times from the first to the last %i fibers' % (result['growth'], arguments.fibers//4))
+            sys.exit(1)
+        sys.exit(0)
+    if arguments.benchmark != 'threads':
+        if arguments.mechanisms:
+            load_mechanisms(arguments.mechanisms)
+        results = suite(CELL_DIR, quick=getattr(arguments, 'quick', False))
+        with open(getattr(arguments, 'output', 'benchmark_results.json'), 'w') as output:
+            json.dump({'neuron': neuron_version(), 'results': results}, output, indent=1)
+        baseline = getattr(arguments, 'baseline', 'benchmark_baseline.json')
+        if getattr(arguments, 'save_baseline', False):
+            with open(baseline, 'w') as output:
+                json.dump({'neuron': neuron_version(), 'results': results}, output, indent=1)
+        elif os.path.exists(baseline):
+            with open(baseline) as stored:
+                regressions = compare(results, json.load(stored)['results'], getattr(arguments, 'tolerance', 0.25))
+            for result, previous in regressions:
+                print('REGRESSION %s: %.4f s, baseline %.4f s' % (', '.join('%s=%s' % (name, result[name]) for name in KEY if name in result), result['time'], previous))
+            sys.exit(1 if regressions else 0)
+        sys.exit(0)
+
+    options = {'MECHANISM_DIR': arguments.mechanisms} if arguments.mechanisms else {}
+    types = ['ABeta', 'ABeta', 'ADelta', 'ABeta']*arguments.fibers
+    diameters = [10.0, 5.7, 3.0, 16.0, 7.3, 12.0, 2.0, 8.7]*arguments.fibers
+    lengths = [(20 + 10*(ii % 5))*1e-3 for ii in range(arguments.fibers)]
+    # the extracellular mechanism only within extracellular_distance of the electrode (none by default), as NEURON 9
+    # integrates a model with any extracellular compartment on a single thread
+    electrode = (10e-3, 1e-3, 0)
+    population = synthetic_population(types[:arguments.fibers], diameters[:arguments.fibers], lengths, CELL_DIR, electrode=electrode,
+                                      extracellular_distance=arguments.extracellular_distance, **options)
+    extracellular = sum(sec.has_membrane('extracellular') for fiber in population for sec in fiber.get_secs())
+    if extracellular:
+        population.stimulate(-0.5, rectangular_pulse(0.1), electrode)
+    else:
+        clamps = current_clamps(population)
+    for result in thread_scaling(population, range(1, arguments.threads+1)):
+        result['extracellular_sections'] = int(extracellular)
+        print(json.dumps(result))
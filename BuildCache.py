@@ -0,0 +1,135 @@
+# Code to cache built ABeta/ADelta fibers on disk (node coordinates, compartment geometry and resting state), so identical fibers are not placed, built and settled again
+
+from __future__ import division
+from numpy import asarray,load,savez
+from fiber_parameters import MRG_TABLE, celsius
+from neuron_runtime import neuron_version
+
+import hashlib
+import os
+import tempfile
+
+class BuildCache(object):
+    '''
+    Content addressed on-disk cache of fiber builds. An entry is keyed on everything the build depends on: the
+    fiber class, the contents of its hoc template, the trajectories, diameters, pain, celsius, variable_STIN (with
+    fine_distance, electrode and electrode_distance), extracellular_distance and interpolate_diameter, and the
+    settling run. It holds the node coordinates and internode lengths, the 3D points of every compartment and the
+    membrane potentials of the settled fiber (see Cell.settle).
+
+    On a hit the node placement, the geometry computation and the settling run are all skipped; the hoc sections
+    are still created. Entries are evicted least recently used first once the cache holds more than max_size bytes.
+    Mechanisms are not part of the key, clear() the cache after changing them.
+
+    directory: where the entries are kept, created if needed; may be shared by several processes
+    max_size: bytes
+    settle_time, dt: ms, settling run of a newly built fiber
+    '''
+    VERSION = 2
+
+    def __init__(self, directory, max_size=1e9, settle_time=100, dt=0.025):
+        self.directory = directory
+        self.max_size = max_size
+        self.settle_time = settle_time
+        self.dt = dt
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.hits, self.misses = 0, 0
+
+    def key(self, fiber_class, arguments):
+        '''
+        Hash of everything the build of fiber_class(**arguments) depends on
+        '''
+        digest = hashlib.sha1()
+        def add(value):
+            digest.update(repr(value).encode())
+        add((self.VERSION, neuron_version(), fiber_class.__name__, sorted(MRG_TABLE.items()), self.settle_time, self.dt))
+        with open(arguments['CELL_DIR']+arguments['CELL_FILE_NAME'], 'rb') as template:
+            digest.update(template.read())
+        for name in ('dorsal_trajectory', 'peripheral_trajectory', 'stem_trajectory'):
+            trajectory = asarray(arguments[name], dtype=float)
+            add(trajectory.shape)
+            digest.update(trajectory.tobytes())
+        for name in ('fiberD_central', 'fiberD_peripheral', 'fiberD_stem', 'pain', 'variable_STIN', 'fine_distance', 'electrode', 'electrode_distance',
+                     'extracellular_distance', 'interpolate_diameter'):
+            add((name, arguments.get(name)))
+        add(('celsius', arguments.get('celsius', celsius))) # the resting state depends on it
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def build(self, fiber_class, **kwargs):
+        '''
+        fiber_class(**kwargs), restored from the cache if it holds this fiber and built, settled and stored otherwise
+        '''
+        key = self.key(fiber_class, kwargs)
+        path = self._path(key)
+        try:
+            with load(path) as entry:
+                entry = dict(entry)
+        except (IOError, OSError, ValueError):
+            entry = None
+
+        if entry is not None:
+            self.hits += 1
+            os.utime(path, None) # most recently used
+            cell = fiber_class(**dict(kwargs, node_coordinates=((entry['nodesDorsal'], entry['dxDorsal']), (entry['nodesPeripheral'], entry['dxPeripheral'])),
+                                      compartment_points=(entry['start'], entry['end'], entry['diams'])))
+            cell.steady_state = entry['steady_state']
+            return cell
+
+        self.misses += 1
+        cell = fiber_class(**kwargs)
+        cell.settle(self.settle_time, self.dt)
+        (nodesDorsal, dxDorsal), (nodesPeripheral, dxPeripheral) = cell.node_coordinates
+        start, end, diams = cell.compartment_points
+
+        # written under a temporary name and renamed, so other processes never read a partial entry
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as output:
+            savez(output, nodesDorsal=nodesDorsal, dxDorsal=dxDorsal, nodesPeripheral=nodesPeripheral, dxPeripheral=dxPeripheral,
+                  start=start, end=end, diams=diams, steady_state=cell.steady_state)
+        os.replace(temporary, path)
+        self.evict()
+        return cell
+
+    def entries(self):
+        '''
+        (last use, size in bytes, path) of every entry, least recently used first
+        '''
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError: # evicted by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for used, size, path in self.entries())
+
+    def evict(self):
+        '''
+        Remove the least recently used entries until the cache holds at most max_size bytes
+        '''
+        entries = self.entries()
+        total = sum(size for used, size, path in entries)
+        for used, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for used, size, path in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
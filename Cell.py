@@ -1,19 +1,522 @@
 # Code to develop the myelinated sensory neurons using the provided hoc files. For details please refer to Graham et al. Neuromodulation: Technology at the Neural Interface 24 (4), 655-671
 
 from __future__ import division
-from neuron import h
-import neuron as nrn
-h.load_file("stdrun.hoc")
-from numpy import pi,shape,array,ones
+from neuron_runtime import h, load_template
+from numpy import pi,shape,array,ascontiguousarray,concatenate,cumsum,empty,hstack,isin,ones,sqrt,where,zeros
 from find_node_coordinates import find_devor_node_coordinates
+from fiber_parameters import celsius, mrg_parameters, mycm, mygm, nodelength, paralength1, periaxonal_resistance, rhoa, space_p1
+from Profiling import FiberMetrics
 
+from contextlib import nullcontext
+
+import re
 import sys
 
+# columns of Cell.get_compartment_table
+COMPARTMENT_TABLE = [('sec', object), ('index', int), ('name', 'U16'), ('type', 'U4'), ('region', 'U4'),
+                     ('x', float), ('y', float), ('z', float), ('L', float), ('diam', float), ('distance', float)]
+
+# parameters of a built fiber that Cell.update_parameters can change
+UPDATABLE_PARAMETERS = ('pain', 'celsius', 'rhoa', 'mycm', 'mygm', 'fiberD_central', 'fiberD_peripheral', 'fiberD_stem')
+
+# default extent (m) of the fully resolved internodes with variable_STIN, from the T-junction and around the electrode,
+# see fine_internodes
+FINE_DISTANCE = 20e-3
+ELECTRODE_DISTANCE = 5e-3
+
+# myelin lamellae of the four stem internodes relative to nl, as in buildCell of the hoc templates
+STEM_LAMELLAE = array([1.0, 0.66197, 0.48592, 0.07747])
+
+def fine_internodes(nodes, dx, fine_distance=FINE_DISTANCE, electrode=None, electrode_distance=ELECTRODE_DISTANCE):
+    '''
+    Number of internodes of an axon, counted from the T-junction, that keep all their STIN compartments with
+    variable_STIN: those within fine_distance (m) along the axon and, with an electrode (x,y,z in m), every one up to
+    the last node within electrode_distance (m) of it. The first three, whose lengths vary, always do.
+    nodes, dx: node coordinates and internode lengths of the axon, see find_devor_node_coordinates
+    '''
+    numFine = int(fine_distance/dx[-1])
+    if electrode is not None:
+        distance = sqrt(((array(nodes, dtype=float) - array(electrode, dtype=float))**2).sum(axis=1))
+        near = (distance <= electrode_distance).nonzero()[0]
+        if len(near):
+            numFine = max(numFine, near[-1]+1)
+    return int(min(max(numFine, 3), len(nodes)-1))
+
+class Cell(object):
+    '''
+    Base class of the sensory neuron models. Keeps the user supplied arguments and builds the cell from them.
+    Every instance builds its own copy of the hoc cell template, so any number of fibers can exist in one process.
+    '''
+    def __init__(self,**kwargs):
+        self.variables = kwargs
+        self.steady_state = None
+        self._secs = None
+        self._compartment_table = None
+        self.metrics = FiberMetrics() if self.variables.get('profile', False) else None # see profile_phase
+        self.rhoa, self.mycm, self.mygm = rhoa, mycm, mygm # as in model_globels, see update_parameters
+        self.celsius = self.variables.get('celsius', celsius) # degC, see initialize
+        self._construct_cell()
+
+    def get_variable(self, name):
+        return self.variables[name]
+
+    def get_secs(self):
+        '''
+        Every section of the cell, grouped by axon and compartment type. The list is built once per cell.
+        '''
+        if self._secs is None:
+            self._secs = self._get_secs()
+        return list(self._secs)
+
+    def get_secs_in_order(self):
+        '''
+        Every section along the fiber: the peripheral axon and the stem from the T-junction on, the initial segment
+        and soma, then the central axon from the T-junction on
+        '''
+        table = self.get_compartment_table()
+        regions = [table['region'] == region for region in ('P', 'T', 'iseg', 'soma', 'C')]
+        return list(concatenate([table['sec'][selected] for selected in regions]))
+
+    def get_compartment_table(self):
+        '''
+        Every compartment of the cell as one row of a NumPy record array, built once per cell, in the order of
+        _compartments() (each axon from the T-junction on, then the initial segment and soma). Columns:
+            sec: the section
+            index: position of the section in get_secs()
+            name: hoc name within the cell, e.g. 'STINP[12]' or 'STINCvar[3]'
+            type: 'node', 'MYSA', 'FLUT', 'STIN', 'iseg' or 'soma'
+            region: 'P', 'T', 'C', 'iseg' or 'soma'
+            x, y, z: midpoint (um)
+            L, diam: um
+            distance: path distance (um) of the midpoint from the T-junction
+        '''
+        if self._compartment_table is None:
+            sections = self._compartments()
+            table = empty(len(sections), dtype=COMPARTMENT_TABLE)
+            table['sec'] = sections
+            position = dict((sec, ii) for ii, sec in enumerate(self.get_secs()))
+            table['index'] = [position.get(sec, -1) for sec in sections]
+            table['name'] = [sec.name().split('.')[-1] for sec in sections]
+            for ii, name in enumerate(table['name']):
+                match = re.match(r'(node|MYSA|FLUT|STIN)([PTC])', name)
+                table['type'][ii], table['region'][ii] = match.groups() if match else (name, name)
+
+            start, end, diams = self.compartment_points
+            table['x'], table['y'], table['z'] = ((start+end)/2).T
+            table['L'] = [sec.L for sec in sections]
+            table['diam'] = diams
+
+            # every axon starts at the T-junction and runs outwards in table order; the initial segment and soma
+            # continue from the end of the stem
+            stem, soma = table['region'] == 'T', ~isin(table['region'], ['P', 'T', 'C'])
+            for selected in (table['region'] == 'P', stem, table['region'] == 'C', soma):
+                table['distance'][selected] = cumsum(table['L'][selected]) - table['L'][selected]/2
+            table['distance'][soma] += table['L'][stem].sum()
+            self._compartment_table = table
+        return self._compartment_table
+
+    def profile_phase(self, name):
+        '''
+        Context manager adding the time and memory spent within it to phase name of metrics (see
+        Profiling.FiberMetrics) when the fiber was built with profile=True, and doing nothing otherwise
+        '''
+        return self.metrics.phase(name) if self.metrics is not None else nullcontext()
+
+    def segments(self):
+        '''
+        Every segment of the cell, in the order of get_secs()
+        '''
+        return [seg for sec in self.get_secs() for seg in sec]
+
+    def settle(self, duration=100, dt=0.025):
+        '''
+        Run the unstimulated cell from v_init to its resting state and keep the membrane potential of every segment
+        in steady_state, which initialize() then starts from. The resting state is that of the temperature of the cell.
+        duration, dt: ms
+        '''
+        with self.profile_phase('settle'):
+            h.celsius = self.celsius
+            h.dt = dt
+            h.finitialize(self.v_init)
+            h.continuerun(duration)
+        self.steady_state = array([seg.v for seg in self.segments()])
+
+    def initialize(self):
+        '''
+        Initialize a simulation: all sections at v_init, or this cell at its steady state if it has one (see settle),
+        with every gating variable in equilibrium with the local membrane potential. NEURON has a single temperature,
+        which is set to the celsius (degC) of this cell.
+        '''
+        with self.profile_phase('initialize'):
+            h.celsius = self.celsius
+            h.finitialize(self.v_init)
+            if self.steady_state is not None:
+                for seg, v in zip(self.segments(), self.steady_state):
+                    seg.v = v
+                h.finitialize()
+
+    def update_parameters(self, **parameters):
+        '''
+        Change parameters of the built fiber in place instead of building a new one: pain, celsius (degC, applied by
+        initialize and settle), rhoa (Ohm-um), mycm (uF/cm2/lamella), mygm (S/cm2/lamella) and fiberD_central,
+        fiberD_peripheral and fiberD_stem (um). What dependent_var() and buildCell derive from them (diameters,
+        lengths, axial and periaxonal resistances, membrane and myelin capacitances and conductances) is recomputed
+        for every compartment from the compartment table and written into the existing sections in one pass.
+        A new diameter also moves the nodes of its axon to the new spacing, which is only allowed while every axon
+        keeps its number of nodes (and, with variable_STIN, of fully resolved internodes); the extracellular region
+        stays where it was. The resting state (see settle) and any point source stimulus of the fiber are dropped.
+        '''
+        for name in parameters:
+            if name not in UPDATABLE_PARAMETERS: raise ValueError('Cannot update %s, choose from %s!!!' % (name, ', '.join(UPDATABLE_PARAMETERS)))
+        with self.profile_phase('update_parameters'):
+            diameters = dict((region, parameters.get('fiberD_'+axon, getattr(self, 'fiberD_'+axon))) for region, axon in (('P', 'peripheral'), ('C', 'central'), ('T', 'stem')))
+            moved = [region for region in ('P', 'C', 'T') if round(diameters[region], 1) != round(getattr(self, 'fiberD_'+{'P': 'peripheral', 'C': 'central', 'T': 'stem'}[region]), 1)]
+            placed = self._place_nodes(diameters, moved) # checks the node counts before anything changes
+
+            self.celsius = parameters.get('celsius', self.celsius)
+            if ('pain' in parameters) and (bool(parameters['pain']) != bool(self.pain)):
+                self._set_pain(parameters['pain'])
+            self.rhoa = parameters.get('rhoa', self.rhoa)
+            self.mycm = parameters.get('mycm', self.mycm)
+            self.mygm = parameters.get('mygm', self.mygm)
+            self.variables.update(parameters)
+
+            if moved:
+                for region, axon in (('P', 'peripheral'), ('C', 'central'), ('T', 'stem')):
+                    setattr(self, 'fiberD_'+axon, diameters[region])
+                    setattr(self.hocCell, 'fiberD_'+axon, round(diameters[region], 1))
+                    setattr(self.hocCell, 'geometry'+region, h.Vector(mrg_parameters(diameters[region], self.interpolate_diameter)['hoc']))
+                self.NODE_COORDINATES_PERIPHERAL, dxPeripheral = placed['P']
+                self.NODE_COORDINATES_DR, dxDorsal = placed['C']
+                self.NODE_COORDINATES_STEM = placed['T'][0]
+                self.node_coordinates = ((self.NODE_COORDINATES_DR, dxDorsal), (self.NODE_COORDINATES_PERIPHERAL, dxPeripheral))
+                self._load_node_coordinates(dxDorsal, dxPeripheral)
+            if set(parameters) - set(['celsius', 'pain']):
+                # keep the hoc variables in step, e.g. for code reading them from the template
+                self.hocCell.rhoa, self.hocCell.mycm, self.hocCell.mygm = self.rhoa, self.mycm, self.mygm
+                self.hocCell.dependent_var()
+                self._set_compartment_parameters(moved)
+
+            self.steady_state = None
+            stimulus = getattr(self, '_point_source_stimulus', None)
+            if stimulus is not None:
+                stimulus[1].stop()
+                self._point_source_stimulus = None
+
+    def _place_nodes(self, diameters, regions):
+        # node coordinates and internode lengths of the axons in regions for the new diameters, the current ones for
+        # the other axons; raises an error if an axon would change its number of nodes or of fine internodes
+        placed = {'P': (self.NODE_COORDINATES_PERIPHERAL, self.node_coordinates[1][1]), 'C': (self.NODE_COORDINATES_DR, self.node_coordinates[0][1]),
+                  'T': (self.NODE_COORDINATES_STEM, None)}
+        axons = {'P': (self.peripheral_trajectory, 'peripheral'), 'C': (self.dorsal_trajectory, 'dorsal'), 'T': (self.stem_trajectory, self.STEM_AXON)}
+        for region in regions:
+            trajectory, axonName = axons[region]
+            nodes, dx = find_devor_node_coordinates(trajectory, axonName, axonType='hybrid', fiberD=diameters[region], interpolate=self.interpolate_diameter)
+            if len(nodes) != len(placed[region][0]): raise ValueError('A diameter of %g um changes the number of nodes of the %s axon, build a new fiber!!!' % (diameters[region], axonName))
+            if ((self.variable_STIN == 1) or (self.variable_STIN == True)) and (region != 'T'):
+                numFine = self.numNodes20mmPeripheral if region == 'P' else self.numNodes20mmCentral
+                if self._fine_internodes(nodes, dx) != numFine: raise ValueError('A diameter of %g um changes the fully resolved internodes of the %s axon, build a new fiber!!!' % (diameters[region], axonName))
+            placed[region] = (nodes, dx)
+        return placed
+
+    def _compartment_parameters(self, moved=()):
+        # what buildCell sets from the diameter dependent geometry and rhoa, mycm and mygm, for every compartment of
+        # the compartment table at once; the compartments of the axons in moved take the lengths and diameters of
+        # their new fiberD. Nodes, initial segment and soma have the xg and xc of their periaxonal space.
+        table = self.get_compartment_table()
+        numSections = len(table)
+        fiberD, innerD, diam, Ra = ones(numSections), ones(numSections), table['diam'].copy(), zeros(numSections)
+        xraxial, lamellae, gm = zeros(numSections), ones(numSections), zeros(numSections)
+        L = self.compartment_lengths.copy()
+        index = array([int(name[name.index('[')+1:-1]) if '[' in name else 0 for name in table['name']])
+        variable = array(['var' in name for name in table['name']])
+        scale = self.rhoa/rhoa # the periaxonal resistances of fiber_parameters are for its rhoa
+        for region in ('P', 'C', 'T'):
+            geometry = mrg_parameters(getattr(self, 'fiberD_'+{'P': 'peripheral', 'C': 'central', 'T': 'stem'}[region]), self.interpolate_diameter)
+            inRegion = table['region'] == region
+            for compartment, inner, resistance, conductance in (('node', 'nodeD', 'Rpn0', 0), ('MYSA', 'paraD1', 'Rpn1', 0.001),
+                                                                  ('FLUT', 'paraD2', 'Rpn2', 0.0001), ('STIN', 'axonD', 'Rpx', 0.0001)):
+                selected = inRegion & (table['type'] == compartment)
+                fiberD[selected] = geometry['nodeD'] if compartment == 'node' else geometry['fiberD']
+                innerD[selected] = geometry[inner]
+                xraxial[selected] = geometry[resistance]*scale
+                gm[selected] = conductance*geometry[inner]/geometry['fiberD']
+                lamellae[selected] = geometry['nl']
+            if region == 'T':
+                # the four stem internodes have fewer lamellae, see STEM_LAMELLAE
+                for compartment, perInternode in (('MYSA', 2), ('FLUT', 2), ('STIN', self.numberOfStinCompartmentsPerStretch)):
+                    selected = inRegion & (table['type'] == compartment)
+                    lamellae[selected] *= STEM_LAMELLAE[index[selected]//perInternode]
+            elif region in moved:
+                # the stem compartments keep their fixed lengths
+                dx = self.node_coordinates[region == 'P'][1]
+                L[inRegion & (table['type'] == 'FLUT')] = geometry['paralength2']
+                stins = inRegion & (table['type'] == 'STIN') & ~variable
+                internode = index[stins]//self.numberOfStinCompartmentsPerStretch
+                first = internode < 3
+                L[stins] = geometry['interlength']
+                L[stins.nonzero()[0][first]] = (dx[internode[first]]*1e6 - nodelength - (2*paralength1) - (2*geometry['paralength2']))/6
+                L[inRegion & variable] = geometry['interlength']*6
+            if region in moved:
+                diam[inRegion] = fiberD[inRegion]
+        Ra[:] = self.rhoa*(fiberD/innerD)**2/10000
+        soma = ~isin(table['region'], ['P', 'T', 'C'])
+        Ra[soma] = self.rhoa/10000
+        xraxial[soma] = periaxonal_resistance(diam[soma], space_p1)*scale
+        myelin = isin(table['type'], ['MYSA', 'FLUT', 'STIN'])
+        xg, xc = where(myelin, self.mygm/(lamellae*2), 1e10), where(myelin, self.mycm/(lamellae*2), 0)
+        return {'sec': table['sec'].tolist(), 'L': L, 'diam': diam, 'Ra': Ra, 'cm': 2*innerD/fiberD, 'g_pas': gm,
+                'xraxial': xraxial, 'xg': xg, 'xc': xc, 'myelin': myelin}
+
+    def _set_extracellular(self):
+        # xraxial, xg and xc of every section with the extracellular mechanism, which the hoc templates only insert
+        # (see insert_extracellular there); set one segment at a time, which unlike the hoc assignment does not set up
+        # the whole model again
+        parameters = self._compartment_parameters()
+        for sec, xraxial, xg, xc in zip(parameters['sec'], parameters['xraxial'].tolist(), parameters['xg'].tolist(), parameters['xc'].tolist()):
+            if sec.has_membrane('extracellular'):
+                seg = sec(0.5)
+                seg.xraxial[0], seg.xg[0], seg.xc[0] = xraxial, xg, xc
+
+    def _set_compartment_parameters(self, moved):
+        # write _compartment_parameters into the sections; the compartments of the axons in moved also take their new
+        # diameters and lengths, and new 3D points
+        parameters = self._compartment_parameters(moved)
+        L, diam, Ra, xraxial, myelin = parameters['L'], parameters['diam'], parameters['Ra'], parameters['xraxial'], parameters['myelin']
+        cm, gm, xg, xc = parameters['cm'], parameters['g_pas'], parameters['xg'], parameters['xc']
+        for ii, sec in enumerate(parameters['sec']):
+            if moved:
+                sec.pt3dclear()
+                sec.L = L[ii]
+                sec.diam = diam[ii]
+            sec.Ra = Ra[ii]
+            seg = sec(0.5)
+            extracellular = sec.has_membrane('extracellular')
+            if extracellular:
+                seg.xraxial[0] = xraxial[ii]
+            if myelin[ii]:
+                if extracellular:
+                    seg.xg[0], seg.xc[0] = xg[ii], xc[ii]
+                    seg.cm, seg.g_pas = cm[ii], gm[ii]
+                else: # folded into the membrane, see insert_extracellular in the hoc templates
+                    seg.cm, seg.g_pas = cm[ii]*xc[ii]/(cm[ii]+xc[ii]), gm[ii]*xg[ii]/(gm[ii]+xg[ii])
+
+        if moved:
+            self.variables.pop('compartment_points', None)
+            self._compartment_table = None
+            self._segment_midpoints = None
+            self._define_geometry()
+
+    def _set_pain(self, pain):
+        # rescale the soma channel densities that buildCell sets from pain, see SOMA_PAIN
+        soma = self.hocCell.soma(0.5)
+        for name, (painless, painful) in self.SOMA_PAIN.items():
+            old, new = (painful, painless) if self.pain else (painless, painful)
+            setattr(soma, name, getattr(soma, name)*new/old)
+        self.pain = pain
+        self.hocCell.pain = 1 if pain else 0
+
+    def _build(self):
+        # the template's build(); profiled fibers take it one step at a time so that buildCell and connect_all are
+        # timed apart
+        if self.metrics is None:
+            self.hocCell.build()
+            return
+        with self.profile_phase('buildCell'):
+            self.hocCell.model_globels()
+            self.hocCell.dependent_var()
+            self.hocCell.create_sections()
+            self.hocCell.buildCell()
+        with self.profile_phase('connect_all'):
+            self.hocCell.connect_all()
+
+    def _internodes(self, region):
+        # sections between neighbouring nodes of the peripheral (P), stem (T) or central (C) axon, see Cell._axon_points;
+        # with variable_STIN, the internodes beyond the fully resolved ones have a single STIN compartment
+        nstins = self.numberOfStinCompartmentsPerStretch
+        node, MYSA, FLUT, STIN = [getattr(self.hocCell, name+region) for name in ('node', 'MYSA', 'FLUT', 'STIN')]
+        numRegular = getattr(self, 'axonnodes'+region)-1
+        if (region != 'T') and ((self.variable_STIN == 1) or (self.variable_STIN == True)):
+            numRegular = self.numNodes20mmCentral if region == 'C' else self.numNodes20mmPeripheral
+        internodes = []
+        for ii in range(getattr(self, 'axonnodes'+region)-1):
+            if ii < numRegular:
+                stins = [STIN[nstins*ii+jj] for jj in range(nstins)]
+            else:
+                stins = [getattr(self.hocCell, 'STIN'+region+'var')[ii-numRegular]]
+            internodes.append([MYSA[2*ii], FLUT[2*ii]] + stins + [FLUT[2*ii+1], MYSA[2*ii+1], node[ii+1]])
+        return internodes
+
+    def _variable_stins(self, region):
+        # single STIN compartments of the peripheral (P) or central (C) axon, see _set_internode_resolution
+        if (self.variable_STIN == 1) or (self.variable_STIN == True):
+            return [getattr(self.hocCell, 'STIN'+region+'var')[ii] for ii in range(getattr(self, 'axonremaininginter'+region))]
+        return []
+
+    def _fine_internodes(self, nodes, dx):
+        # fine_internodes of an axon of this cell, with its fine_distance, electrode and electrode_distance
+        return fine_internodes(nodes, dx, self.fine_distance, self.electrode, self.electrode_distance)
+
+    def _set_internode_resolution(self, dxDorsal, dxPeripheral):
+        # with variable_STIN, the internodes of the peripheral and central axon beyond _fine_internodes are lumped
+        # into a single STIN compartment of the same length; numNodes20mm* keep their hoc names from the former fixed
+        # 20 mm cutoff
+        self.fine_distance = self.variables.get('fine_distance', FINE_DISTANCE) # m
+        self.electrode = self.variables.get('electrode') # (x,y,z) in m
+        self.electrode_distance = self.variables.get('electrode_distance', ELECTRODE_DISTANCE) # m
+        self.numberOfStinCompartmentsPerVariableStretch = 1
+        self.hocCell.numberOfStinCompartmentsPerVariableStretch = self.numberOfStinCompartmentsPerVariableStretch
+
+        if (self.variable_STIN == 1) or (self.variable_STIN == True):
+            self.hocCell.variable_STIN = 1
+            self.numNodes20mmCentral = self._fine_internodes(self.NODE_COORDINATES_DR[:self.axonnodesC], dxDorsal)
+            self.numNodes20mmPeripheral = self._fine_internodes(self.NODE_COORDINATES_PERIPHERAL[:self.axonnodesP], dxPeripheral)
+            self.remainingNodesCentral = self.axonnodesC - self.numNodes20mmCentral
+            self.remainingNodesPeripheral = self.axonnodesP - self.numNodes20mmPeripheral
+
+            self.axoninterP = self.numberOfStinCompartmentsPerStretch*(self.numNodes20mmPeripheral)
+            self.axoninterC = self.numberOfStinCompartmentsPerStretch*(self.numNodes20mmCentral)
+            self.axonremaininginterP = self.numberOfStinCompartmentsPerVariableStretch*(self.remainingNodesPeripheral-1)
+            self.axonremaininginterC = self.numberOfStinCompartmentsPerVariableStretch*(self.remainingNodesCentral-1)
+
+            self.hocCell.axoninterP = self.axoninterP
+            self.hocCell.axoninterC = self.axoninterC
+            self.hocCell.axonremaininginterP = self.axonremaininginterP
+            self.hocCell.axonremaininginterC = self.axonremaininginterC
+            self.hocCell.numNodes20mmPeripheral = self.numNodes20mmPeripheral
+            self.hocCell.numNodes20mmCentral = self.numNodes20mmCentral
+
+        else:
+            self.hocCell.variable_STIN = 0
+            self.axoninterP = self.numberOfStinCompartmentsPerStretch*(self.axonnodesP-1)
+            self.axoninterC = self.numberOfStinCompartmentsPerStretch*(self.axonnodesC-1)
+            self.hocCell.axoninterP = self.axoninterP
+            self.hocCell.axoninterC = self.axoninterC
+
+    def _set_extracellular_region(self):
+        # with an extracellular_distance, only the nodes within it of the electrode and the internodes next to them
+        # get the extracellular mechanism (see insert_extracellular in the hoc templates); elsewhere the myelin is
+        # folded into a single cable, which is what the double cable amounts to where e_extracellular stays zero
+        self.extracellular_distance = self.variables.get('extracellular_distance') # m
+        if (self.extracellular_distance is not None) and (self.electrode is None): raise TypeError('Need to specify the electrode position to restrict the extracellular mechanism to!!!')
+        for region, nodes in (('P', self.NODE_COORDINATES_PERIPHERAL[:self.axonnodesP]), ('C', self.NODE_COORDINATES_DR[:self.axonnodesC]),
+                              ('T', self.NODE_COORDINATES_STEM[:self.axonnodesT])):
+            if self.extracellular_distance is None:
+                inside = ones(len(nodes))
+            else:
+                inside = sqrt(((array(nodes, dtype=float) - array(self.electrode, dtype=float))**2).sum(axis=1)) <= self.extracellular_distance
+            setattr(self.hocCell, 'extracellular'+region, h.Vector(ascontiguousarray(inside, dtype=float)))
+
+    def _load_node_coordinates(self, dxDorsal, dxPeripheral):
+        # hand the node coordinates and the first three internode lengths to hoc as whole arrays, one Vector each
+        regions = (('C', self.NODE_COORDINATES_DR[:self.axonnodesC]), ('P', self.NODE_COORDINATES_PERIPHERAL[:self.axonnodesP]),
+                   ('T', self.NODE_COORDINATES_STEM[:self.numStemCompartments]))
+        for region, coordinates in regions:
+            coordinates = ascontiguousarray(array(coordinates, dtype=float).T)
+            setattr(self.hocCell, 'nx'+region, h.Vector(coordinates[0]))
+            setattr(self.hocCell, 'ny'+region, h.Vector(coordinates[1]))
+            setattr(self.hocCell, 'nz'+region, h.Vector(coordinates[2]))
+
+        # account for normalized variable internode lengths to put in for STIN lengths
+        self.hocCell.varLenP = h.Vector(ascontiguousarray(dxPeripheral[:3], dtype=float))
+        self.hocCell.varLenC = h.Vector(ascontiguousarray(dxDorsal[:3], dtype=float))
+
+    def _compartments(self):
+        # every section that takes 3D points, in the order of compartment_points: each axon (peripheral, stem, central)
+        # from its first node on, then the initial segment and soma
+        sections = []
+        for region in ('P', 'T', 'C'):
+            sections.append(getattr(self.hocCell, 'node'+region)[0])
+            for internode in self._internodes(region):
+                sections.extend(internode)
+        return sections + self._soma_sections()
+
+    def _define_geometry(self):
+        '''
+        3D points of every compartment, placed along the straight line between neighbouring nodes. The points of a
+        whole axon are computed in one NumPy pass with the arithmetic of the original define_geometry() hoc loop,
+        so the geometry is the same, and each section then takes its two points.
+        The start and end points (um) and diameters of the compartments are kept in compartment_points, in the
+        order of _compartments().
+        '''
+        if 'compartment_points' in self.variables: # computed beforehand, e.g. restored from a BuildCache
+            self.compartment_points = self.get_variable('compartment_points')
+        else:
+            self.compartment_points = self._compartment_points()
+
+        sections = self._compartments()
+        self.compartment_lengths = array([sec.L for sec in sections]) # as set by buildCell, before the 3D points
+        start, end, diams = self.compartment_points
+        for sec, (x0, y0, z0), (x1, y1, z1), diam in zip(sections, start.tolist(), end.tolist(), diams.tolist()):
+            sec.pt3dadd(x0, y0, z0, diam)
+            sec.pt3dadd(x1, y1, z1, diam)
+
+    def _compartment_points(self):
+        nodeL = self.hocCell.nodeP[0].L
+        peripheral = self._axon_points(self.NODE_COORDINATES_PERIPHERAL[:self.axonnodesP], self.hocCell.nodeP[0], self._internodes('P'), -1*nodeL/2, nodeL/2)
+        stem = self._axon_points(self.NODE_COORDINATES_STEM[:self.axonnodesT], self.hocCell.nodeT[0], self._internodes('T'), 0, nodeL)
+        central = self._axon_points(self.NODE_COORDINATES_DR[:self.axonnodesC], self.hocCell.nodeC[0], self._internodes('C'), 0, nodeL/2)
+        soma = self._soma_points(stem[3]) + (array([sec.diam for sec in self._soma_sections()]),)
+
+        parts = (peripheral, stem, central, soma)
+        return tuple(concatenate([part[ii] for part in parts]) for ii in range(3))
+
+    def _axon_points(self, nodes, firstNode, internodes, firstNodeStart, internodeStart):
+        '''
+        nodes: (n,3) node coordinates (m)
+        internodes: for every pair of neighbouring nodes, the sections from the first one towards the second one,
+            ending with the second node
+        firstNodeStart, internodeStart: um past the node where the first node and the first compartment of each
+            internode start
+        returns the start and end points (um) and the diameters of the first node and the internode sections, and
+            where the last internode ends as a fraction of its length
+        '''
+        points = array(nodes, dtype=float)*1e6 # um
+        P0, P1 = points[:-1], points[1:]
+        P0P1 = sqrt((P1[:,0]-P0[:,0])**2+(P1[:,1]-P0[:,1])**2+(P1[:,2]-P0[:,2])**2)
+
+        t0 = firstNodeStart/P0P1[0]
+        start, end = [None]*(len(internodes)+1), [None]*(len(internodes)+1)
+        start[0], end[0] = self._section_points(P0[:1], P1[:1], array([[t0, t0+firstNode.L/P0P1[0]]]))
+
+        # internodes of the same number of compartments are placed together; the cumulative sum runs in the same
+        # order as the hoc loop, so every point is exactly the same
+        ends = zeros(len(internodes))
+        for numSections in set(len(internode) for internode in internodes):
+            ii = array([jj for jj, internode in enumerate(internodes) if len(internode) == numSections])
+            lengths = array([[sec.L for sec in internodes[jj]] for jj in ii])
+            t = cumsum(hstack(((internodeStart/P0P1[ii])[:,None], lengths/P0P1[ii,None])), axis=1)
+            xyz = (1-t)[:,:,None]*P0[ii,None,:] + t[:,:,None]*P1[ii,None,:]
+            for row, jj in enumerate(ii):
+                start[jj+1], end[jj+1] = xyz[row,:-1], xyz[row,1:]
+            ends[ii] = t[:,-1]
+
+        # the nodes of an axon share one diameter and its other compartments another (the fiber diameter), so only
+        # those two are read from hoc
+        nodeD = firstNode.diam
+        fiberD = internodes[0][0].diam if len(internodes) else nodeD
+        diams = [nodeD]
+        for internode in internodes:
+            diams.extend([fiberD]*(len(internode)-1) + [nodeD])
+
+        return concatenate(start), concatenate(end), array(diams), ends[-1]
+
+    def _section_points(self, P0, P1, t):
+        # row ii of t holds the boundaries of consecutive sections along the line from P0[ii] to P1[ii]
+        xyz = (1-t)[:,:,None]*P0[:,None,:] + t[:,:,None]*P1[:,None,:]
+        return xyz[:,:-1].reshape(-1, 3), xyz[:,1:].reshape(-1, 3)
+
 class ABetaFiber(Cell):
     '''
     Hybrid model of an ABeta Sensory Neuron. MRG Myelination, with variable node spacing near 
     t junction seen in (Ito & Takahashi 1960, Amir and Devor 2003).
     '''
+    STEM_AXON = 'stemMRG' # node placement of the stem axon, see find_devor_node_coordinates
+    # soma channel densities buildCell scales by pain, as (factor without pain, factor with pain)
+    SOMA_PAIN = {'gnabar_sensoryAxnode': (300/2000, 550/2000), 'gnapbar_sensoryAxnode': (300/2000, 550/2000),
+                 'gkfbar_sensoryAxnode': (1, 0.8), 'gksbar_sensoryAxnode': (1, 0.8)}
+    STEM_NODES = 5 # nodes of the stem axon, the remaining stem coordinates lead to the soma
+
     def __init__(self,**kwargs):
         self.variables = kwargs
         if 'peripheral_trajectory' not in self.variables: raise TypeError('Need to specify peripheral axon trajectory!!!')
@@ -34,64 +537,40 @@ class ABetaFiber(Cell):
     def __str__(self):
         return "DRG ABeta Cell"
 
-    def get_secs(self):
-        secs = [sec for sec in h.nodeP]
-        secs.extend([sec for sec in h.MYSAP])
-        secs.extend([sec for sec in h.FLUTP])
-        secs.extend([sec for sec in h.STINP])
-
-        secs.extend([sec for sec in h.nodeC])
-        secs.extend([sec for sec in h.MYSAC])
-        secs.extend([sec for sec in h.FLUTC])
-        secs.extend([sec for sec in h.STINC])
-
-        secs.extend([sec for sec in h.nodeT])
-        secs.extend([sec for sec in h.MYSAT])
-        secs.extend([sec for sec in h.FLUTT])
-        secs.extend([sec for sec in h.STINT])
+    def _get_secs(self):
+        secs = [sec for sec in self.hocCell.nodeP]
+        secs.extend([sec for sec in self.hocCell.MYSAP])
+        secs.extend([sec for sec in self.hocCell.FLUTP])
+        secs.extend([sec for sec in self.hocCell.STINP])
+        secs.extend(self._variable_stins('P'))
+
+        secs.extend([sec for sec in self.hocCell.nodeC])
+        secs.extend([sec for sec in self.hocCell.MYSAC])
+        secs.extend([sec for sec in self.hocCell.FLUTC])
+        secs.extend([sec for sec in self.hocCell.STINC])
+        secs.extend(self._variable_stins('C'))
+
+        secs.extend([sec for sec in self.hocCell.nodeT])
+        secs.extend([sec for sec in self.hocCell.MYSAT])
+        secs.extend([sec for sec in self.hocCell.FLUTT])
+        secs.extend([sec for sec in self.hocCell.STINT])
         
-        secs.append(h.iseg)
-        secs.append(h.soma)
+        secs.append(self.hocCell.iseg)
+        secs.append(self.hocCell.soma)
 
         return secs
 
-    def get_secs_in_order(self):
-        nstins = self.numberOfStinCompartmentsPerStretch
-        secs = []
-        for ii in range(self.axonnodesP-1):
-            if ii == 0:
-                secs.append(h.nodeP[ii])
-            secs.append(h.MYSAP[2*ii])
-            secs.append(h.FLUTP[2*ii])
-            for jj in range(nstins):
-                secs.append(h.STINP[nstins*ii+jj])
-            secs.append(h.FLUTP[2*ii+1])
-            secs.append(h.MYSAP[2*ii+1])
-            secs.append(h.nodeP[ii+1])
-        for ii in range(self.axonnodesT-1):
-            if ii == 0:
-                secs.append(h.nodeT[ii])
-            secs.append(h.MYSAT[2*ii])
-            secs.append(h.FLUTT[2*ii])
-            for jj in range(nstins):
-                secs.append(h.STINT[nstins*ii+jj])
-            secs.append(h.FLUTT[2*ii+1])
-            secs.append(h.MYSAT[2*ii+1])
-            secs.append(h.nodeT[ii+1])
-        secs.append(h.iseg)
-        secs.append(h.soma)
-        for ii in range(self.axonnodesC-1):
-            if ii == 0:
-                secs.append(h.nodeC[ii])
-            secs.append(h.MYSAC[2*ii])
-            secs.append(h.FLUTC[2*ii])
-            for jj in range(nstins):
-                secs.append(h.STINC[nstins*ii+jj])
-            secs.append(h.FLUTC[2*ii+1])
-            secs.append(h.MYSAC[2*ii+1])
-            secs.append(h.nodeC[ii+1])
+    def _soma_sections(self):
+        return [self.hocCell.iseg, self.hocCell.soma]
 
-        return secs
+    def _soma_points(self, stemEnd):
+        # initial segment and soma continue from the last stem node towards the soma coordinate
+        points = array(self.NODE_COORDINATES_STEM, dtype=float)*1e6 # um
+        P0, P1 = points[self.axonnodesT-1], points[self.axonnodesT+1]
+        P0P1 = sqrt((P1[0]-P0[0])**2+(P1[1]-P0[1])**2+(P1[2]-P0[2])**2) - 1
+        t0 = 0
+        t1 = t0+self.hocCell.iseg.L/P0P1
+        return self._section_points(P0[None], P1[None], array([[t0, t1, t1+self.hocCell.soma.L/P0P1]]))
 
     def _construct_cell(self):
         # self.central_trajectory = self.get_variable('central_trajectory')
@@ -102,17 +581,24 @@ class ABetaFiber(Cell):
         self.fiberD_peripheral = self.get_variable('fiberD_peripheral')
         self.fiberD_stem = self.get_variable('fiberD_stem')
         self.pain = self.get_variable('pain')
+        self.interpolate_diameter = self.variables.get('interpolate_diameter', False) # allow diameters between the tabulated MRG ones
+        self.variable_STIN = self.variables.get('variable_STIN', False) # coarsen the internodes away from the T-junction and electrode
 
-        self.NODE_COORDINATES_DR, dxDorsal = find_devor_node_coordinates(self.dorsal_trajectory, 'dorsal', axonType='hybrid', fiberD=self.fiberD_central)
-        self.NODE_COORDINATES_PERIPHERAL, dxPeripheral = find_devor_node_coordinates(self.peripheral_trajectory, 'peripheral', axonType='hybrid', fiberD=self.fiberD_peripheral)
-        self.NODE_COORDINATES_STEM, dxDontUse = find_devor_node_coordinates(self.stem_trajectory, 'stemMRG', axonType='hybrid', fiberD=self.fiberD_stem)
+        with self.profile_phase('node_placement'):
+            if 'node_coordinates' in self.variables: # placed beforehand, e.g. for a whole FiberPopulation at once
+                (self.NODE_COORDINATES_DR, dxDorsal), (self.NODE_COORDINATES_PERIPHERAL, dxPeripheral) = self.get_variable('node_coordinates')
+            else:
+                self.NODE_COORDINATES_DR, dxDorsal = find_devor_node_coordinates(self.dorsal_trajectory, 'dorsal', axonType='hybrid', fiberD=self.fiberD_central, interpolate=self.interpolate_diameter)
+                self.NODE_COORDINATES_PERIPHERAL, dxPeripheral = find_devor_node_coordinates(self.peripheral_trajectory, 'peripheral', axonType='hybrid', fiberD=self.fiberD_peripheral, interpolate=self.interpolate_diameter)
+            self.node_coordinates = ((self.NODE_COORDINATES_DR, dxDorsal), (self.NODE_COORDINATES_PERIPHERAL, dxPeripheral))
+            self.NODE_COORDINATES_STEM, dxDontUse = find_devor_node_coordinates(self.stem_trajectory, self.STEM_AXON, axonType='hybrid', fiberD=self.fiberD_stem, interpolate=self.interpolate_diameter)
 
 
         self.numberOfStinCompartmentsPerStretch = 6
 
         self.axonnodesP = shape(self.NODE_COORDINATES_PERIPHERAL)[0]
         self.axonnodesC = shape(self.NODE_COORDINATES_DR)[0]
-        self.axonnodesT = 5
+        self.axonnodesT = self.STEM_NODES
         self.numStemCompartments = 7
 
         self.paranodes1P = 2*(self.axonnodesP-1)
@@ -121,8 +607,6 @@ class ABetaFiber(Cell):
         self.paranodes2P = 2*(self.axonnodesP-1)
         self.paranodes2C = 2*(self.axonnodesC-1)
         self.paranodes2T = 2*(self.axonnodesT-1)
-        self.axoninterP = self.numberOfStinCompartmentsPerStretch*(self.axonnodesP-1)
-        self.axoninterC = self.numberOfStinCompartmentsPerStretch*(self.axonnodesC-1)
         self.axoninterT = self.numberOfStinCompartmentsPerStretch*(self.axonnodesT-1)
 
         self.axonnodesAbC = 4
@@ -134,90 +618,66 @@ class ABetaFiber(Cell):
         self.axoninterAbC = self.numberOfStinCompartmentsPerStretch*(self.axonnodesAbC-1)
         self.axoninterAbP = self.numberOfStinCompartmentsPerStretch*(self.axonnodesAbP-1)
         
-        # define necessary parameters
-        h('fiberD_central = %.1f' % self.fiberD_central)
-        h('fiberD_peripheral = %.1f' % self.fiberD_peripheral)
-        h('fiberD_stem = %.1f' % self.fiberD_stem)
-        h('numberOfStinCompartmentsPerStretch = %i' % self.numberOfStinCompartmentsPerStretch)
-        h('axonnodesP = %i' % self.axonnodesP)
-        h('axonnodesC = %i' % self.axonnodesC)
-        h('paranodes1P = %i' % self.paranodes1P)
-        h('paranodes1C = %i' % self.paranodes1C)
-        h('paranodes2P = %i' % self.paranodes2P)
-        h('paranodes2C = %i' % self.paranodes2C)
-        h('axoninterP = %i' % self.axoninterP)
-        h('axoninterC = %i' % self.axoninterC)
-        h('axonnodesT = %i' % self.axonnodesT)
-        h('paranodes1T = %i' % self.paranodes1T)
-        h('paranodes2T = %i' % self.paranodes2T)
-        h('axoninterT = %i' % self.axoninterT)
-
-        h('axonnodesAbC = %i' % self.axonnodesAbC)
-        h('axonnodesAbP = %i' % self.axonnodesAbP)
-        h('paranodes1AbC = %i' % self.paranodes1AbC)
-        h('paranodes1AbP = %i' % self.paranodes1AbP)
-        h('paranodes2AbC = %i' % self.paranodes2AbC)
-        h('paranodes2AbP = %i' % self.paranodes2AbP)
-        h('axoninterAbC = %i' % self.axoninterAbC)
-        h('axoninterAbP = %i' % self.axoninterAbP)
-
-        if (self.pain == True):
-            h('pain = 1')
-        else:
-            h('pain = 0')
-
-        # load node coordinates into hoc
-        h('objref nxC')
-        h('objref nxP')
-        h('objref nxT')
-        h('objref nyC')
-        h('objref nyP')
-        h('objref nyT')
-        h('objref nzC')
-        h('objref nzP')
-        h('objref nzT')
-        h('nxC = new Vector(%i)' % self.axonnodesC)
-        h('nxP = new Vector(%i)' % self.axonnodesP)
-        h('nxT = new Vector(%i)' % self.numStemCompartments)
-        h('nyC = new Vector(%i)' % self.axonnodesC)
-        h('nyP = new Vector(%i)' % self.axonnodesP)
-        h('nyT = new Vector(%i)' % self.numStemCompartments)
-        h('nzC = new Vector(%i)' % self.axonnodesC)
-        h('nzP = new Vector(%i)' % self.axonnodesP)
-        h('nzT = new Vector(%i)' % self.numStemCompartments)
-        for i in range(self.axonnodesC):
-            h.nxC.x[i] = self.NODE_COORDINATES_DR[i,0]
-            h.nyC.x[i] = self.NODE_COORDINATES_DR[i,1]
-            h.nzC.x[i] = self.NODE_COORDINATES_DR[i,2]
-        for i in range(self.axonnodesP):
-            h.nxP.x[i] = self.NODE_COORDINATES_PERIPHERAL[i,0]
-            h.nyP.x[i] = self.NODE_COORDINATES_PERIPHERAL[i,1]
-            h.nzP.x[i] = self.NODE_COORDINATES_PERIPHERAL[i,2]
-        for i in range(self.numStemCompartments):
-            h.nxT.x[i] = self.NODE_COORDINATES_STEM[i,0]
-            h.nyT.x[i] = self.NODE_COORDINATES_STEM[i,1]
-            h.nzT.x[i] = self.NODE_COORDINATES_STEM[i,2]
-
-        # account for normalized variable internode lengths to put in for STIN lengths
-        h('objref varLenP')
-        h('objref varLenC')
-        h('varLenP = new Vector(3)')
-        h('varLenC = new Vector(3)')
-        for ii in range(3):
-            h.varLenP.x[ii] = dxPeripheral[ii]
-            h.varLenC.x[ii] = dxDorsal[ii]
-
-        h.load_file(1, self.CELL_DIR+self.CELL_FILE_NAME)
-        self.endP = h.nodeP[self.axonnodesP-1] # end of peripheral axon
-        self.endC = h.nodeC[self.axonnodesC-1] # end of central axon
-        self.soma = h.soma # soma
-        self.TjuncStem = h.nodeT[0] # t-junction at stem axon
-        self.TjuncP = h.nodeP[0] # t-junction in peripheral axon
-        self.TjuncC = h.nodeC[0] # t-junction in central axon
-        self.midCentral = h.nodeC[int(self.axonnodesC/2)] # midway along central axon
-        self.midPeripheral = h.nodeP[int(self.axonnodesP/2)] # midway along peripheral axon
+        # load the cell template once per process and create this fiber's own instance of it
+        with self.profile_phase('load_file'):
+            self.hocCell = load_template(self.CELL_DIR+self.CELL_FILE_NAME)()
+
+        with self.profile_phase('parameters'):
+            # define necessary parameters
+            self.hocCell.fiberD_central = round(self.fiberD_central, 1)
+            self.hocCell.fiberD_peripheral = round(self.fiberD_peripheral, 1)
+            self.hocCell.fiberD_stem = round(self.fiberD_stem, 1)
+
+            # diameter dependent geometry and periaxonal resistances, computed once per diameter and shared by all fibers
+            self.hocCell.geometryC = h.Vector(mrg_parameters(self.fiberD_central, self.interpolate_diameter)['hoc'])
+            self.hocCell.geometryP = h.Vector(mrg_parameters(self.fiberD_peripheral, self.interpolate_diameter)['hoc'])
+            self.hocCell.geometryT = h.Vector(mrg_parameters(self.fiberD_stem, self.interpolate_diameter)['hoc'])
+            self.hocCell.numberOfStinCompartmentsPerStretch = self.numberOfStinCompartmentsPerStretch
+            self.hocCell.axonnodesP = self.axonnodesP
+            self.hocCell.axonnodesC = self.axonnodesC
+            self.hocCell.paranodes1P = self.paranodes1P
+            self.hocCell.paranodes1C = self.paranodes1C
+            self.hocCell.paranodes2P = self.paranodes2P
+            self.hocCell.paranodes2C = self.paranodes2C
+            self.hocCell.axonnodesT = self.axonnodesT
+            self.hocCell.paranodes1T = self.paranodes1T
+            self.hocCell.paranodes2T = self.paranodes2T
+            self.hocCell.axoninterT = self.axoninterT
+
+            self._set_internode_resolution(dxDorsal, dxPeripheral)
+            self._set_extracellular_region()
+
+            if (self.pain == True):
+                self.hocCell.pain = 1
+            else:
+                self.hocCell.pain = 0
+            self.hocCell.verbose = 1 if self.variables.get('verbose', False) else 0 # print the progress of connect_all
+
+            self._load_node_coordinates(dxDorsal, dxPeripheral)
+
+        self._build()
+        with self.profile_phase('define_geometry'):
+            self._define_geometry()
+        with self.profile_phase('extracellular'):
+            self._set_extracellular()
+        self.v_init = h.v_init # resting potential set by the template, used to initialize simulations of this fiber
+
+        self.endP = self.hocCell.nodeP[self.axonnodesP-1] # end of peripheral axon
+        self.endC = self.hocCell.nodeC[self.axonnodesC-1] # end of central axon
+        self.soma = self.hocCell.soma # soma
+        self.TjuncStem = self.hocCell.nodeT[0] # t-junction at stem axon
+        self.TjuncP = self.hocCell.nodeP[0] # t-junction in peripheral axon
+        self.TjuncC = self.hocCell.nodeC[0] # t-junction in central axon
+        self.midCentral = self.hocCell.nodeC[int(self.axonnodesC/2)] # midway along central axon
+        self.midPeripheral = self.hocCell.nodeP[int(self.axonnodesP/2)] # midway along peripheral axon
+        if self.metrics is not None:
+            self.metrics.count(self)
 
 class ADeltaFiber(Cell):
+    STEM_AXON = 'stemMRG_adelta' # node placement of the stem axon, see find_devor_node_coordinates
+    # soma channel densities buildCell scales by pain, as (factor without pain, factor with pain)
+    SOMA_PAIN = {'gna1p6bar_nav1p6': (1.0, 1.67), 'gkdrbar_kdr': (1, 0.8), 'gkabar_ka': (1, 0.8)}
+    STEM_NODES = 5 # nodes of the stem axon, the remaining stem coordinates lead to the soma
 
     def __init__(self,**kwargs):
         self.variables = kwargs
@@ -240,28 +700,37 @@ class ADeltaFiber(Cell):
     def __str__(self):
         return "DRG ADelta Cell"
 
-    def get_secs(self):
-        secs = [sec for sec in h.nodeP]
-        secs.extend([sec for sec in h.MYSAP])
-        secs.extend([sec for sec in h.FLUTP])
-        secs.extend([sec for sec in h.STINP])
-        if (self.variable_STIN == 1) or (self.variable_STIN == True):
-            secs.extend([sec for sec in h.STINPvar])
+    def _get_secs(self):
+        secs = [sec for sec in self.hocCell.nodeP]
+        secs.extend([sec for sec in self.hocCell.MYSAP])
+        secs.extend([sec for sec in self.hocCell.FLUTP])
+        secs.extend([sec for sec in self.hocCell.STINP])
+        secs.extend(self._variable_stins('P'))
+
+        secs.extend([sec for sec in self.hocCell.nodeC])
+        secs.extend([sec for sec in self.hocCell.MYSAC])
+        secs.extend([sec for sec in self.hocCell.FLUTC])
+        secs.extend([sec for sec in self.hocCell.STINC])
+        secs.extend(self._variable_stins('C'))
+
+        secs.extend([sec for sec in self.hocCell.nodeT])
+        secs.extend([sec for sec in self.hocCell.MYSAT])
+        secs.extend([sec for sec in self.hocCell.FLUTT])
+        secs.extend([sec for sec in self.hocCell.STINT])
+        secs.append(self.hocCell.soma)
 
-        secs.extend([sec for sec in h.nodeC])
-        secs.extend([sec for sec in h.MYSAC])
-        secs.extend([sec for sec in h.FLUTC])
-        secs.extend([sec for sec in h.STINC])
-        if (self.variable_STIN == 1) or (self.variable_STIN == True):
-            secs.extend([sec for sec in h.STINCvar])
+        return secs
 
-        secs.extend([sec for sec in h.nodeT])
-        secs.extend([sec for sec in h.MYSAT])
-        secs.extend([sec for sec in h.FLUTT])
-        secs.extend([sec for sec in h.STINT])
-        secs.append(h.soma)
+    def _soma_sections(self):
+        return [self.hocCell.soma]
 
-        return secs
+    def _soma_points(self, stemEnd):
+        # the soma continues from where the last stem internode ends, along the line from the last stem node
+        # towards the soma coordinate
+        points = array(self.NODE_COORDINATES_STEM, dtype=float)*1e6 # um
+        P0, P1 = points[self.axonnodesT-1], points[self.axonnodesT]
+        P0P1 = sqrt((P1[0]-P0[0])**2+(P1[1]-P0[1])**2+(P1[2]-P0[2])**2) - 1
+        return self._section_points(P0[None], P1[None], array([[stemEnd, stemEnd+self.hocCell.soma.L/P0P1]]))
 
     def _construct_cell(self):
         # self.central_trajectory = self.get_variable('central_trajectory')
@@ -272,18 +741,23 @@ class ADeltaFiber(Cell):
         self.fiberD_peripheral = self.get_variable('fiberD_peripheral')
         self.fiberD_stem = self.get_variable('fiberD_stem')
         self.pain = self.get_variable('pain')
+        self.interpolate_diameter = self.variables.get('interpolate_diameter', False) # allow diameters between the tabulated MRG ones
         self.variable_STIN = self.get_variable('variable_STIN')
 
-        self.NODE_COORDINATES_DR, dxDorsal = find_devor_node_coordinates(self.dorsal_trajectory, 'dorsal', axonType='hybrid', fiberD=self.fiberD_central)
-        self.NODE_COORDINATES_PERIPHERAL, dxPeripheral = find_devor_node_coordinates(self.peripheral_trajectory, 'peripheral', axonType='hybrid', fiberD=self.fiberD_peripheral)
-        self.NODE_COORDINATES_STEM, dxDontUse = find_devor_node_coordinates(self.stem_trajectory, 'stemMRG_adelta', axonType='hybrid', fiberD=self.fiberD_stem)
+        with self.profile_phase('node_placement'):
+            if 'node_coordinates' in self.variables: # placed beforehand, e.g. for a whole FiberPopulation at once
+                (self.NODE_COORDINATES_DR, dxDorsal), (self.NODE_COORDINATES_PERIPHERAL, dxPeripheral) = self.get_variable('node_coordinates')
+            else:
+                self.NODE_COORDINATES_DR, dxDorsal = find_devor_node_coordinates(self.dorsal_trajectory, 'dorsal', axonType='hybrid', fiberD=self.fiberD_central, interpolate=self.interpolate_diameter)
+                self.NODE_COORDINATES_PERIPHERAL, dxPeripheral = find_devor_node_coordinates(self.peripheral_trajectory, 'peripheral', axonType='hybrid', fiberD=self.fiberD_peripheral, interpolate=self.interpolate_diameter)
+            self.node_coordinates = ((self.NODE_COORDINATES_DR, dxDorsal), (self.NODE_COORDINATES_PERIPHERAL, dxPeripheral))
+            self.NODE_COORDINATES_STEM, dxDontUse = find_devor_node_coordinates(self.stem_trajectory, self.STEM_AXON, axonType='hybrid', fiberD=self.fiberD_stem, interpolate=self.interpolate_diameter)
 
         self.numberOfStinCompartmentsPerStretch = 6
-        self.numberOfStinCompartmentsPerVariableStretch = 1
 
         self.axonnodesP = shape(self.NODE_COORDINATES_PERIPHERAL)[0]
         self.axonnodesC = shape(self.NODE_COORDINATES_DR)[0]
-        self.axonnodesT = 5
+        self.axonnodesT = self.STEM_NODES
         self.numStemCompartments = 6
 
         self.paranodes1P = 2*(self.axonnodesP-1)
@@ -294,104 +768,57 @@ class ADeltaFiber(Cell):
         self.paranodes2T = 2*(self.axonnodesT-1)
         self.axoninterT = self.numberOfStinCompartmentsPerStretch*(self.axonnodesT-1)
         
-        # define necessary parameters
-        h('fiberD_central = %.1f' % self.fiberD_central)
-        h('fiberD_peripheral = %.1f' % self.fiberD_peripheral)
-        h('fiberD_stem = %.1f' % self.fiberD_stem)
-        h('numberOfStinCompartmentsPerStretch = %i' % self.numberOfStinCompartmentsPerStretch)
-        h('numberOfStinCompartmentsPerVariableStretch = %i' % self.numberOfStinCompartmentsPerVariableStretch)
-        h('axonnodesP = %i' % self.axonnodesP)
-        h('axonnodesC = %i' % self.axonnodesC)
-        h('paranodes1P = %i' % self.paranodes1P)
-        h('paranodes1C = %i' % self.paranodes1C)
-        h('paranodes2P = %i' % self.paranodes2P)
-        h('paranodes2C = %i' % self.paranodes2C)
-        h('axonnodesT = %i' % self.axonnodesT)
-        h('paranodes1T = %i' % self.paranodes1T)
-        h('paranodes2T = %i' % self.paranodes2T)
-        h('axoninterT = %i' % self.axoninterT)
-
-        if (self.variable_STIN == 1) or (self.variable_STIN == True):
-            h('variable_STIN = 1')
-            dxC = dxDorsal[-1]
-            dxP = dxPeripheral[-1]
-            self.numNodes20mmCentral = int(20e-3/dxC)
-            self.numNodes20mmPeripheral = int(20e-3/dxP)
-            self.remainingNodesCentral = self.axonnodesC - self.numNodes20mmCentral
-            self.remainingNodesPeripheral = self.axonnodesP - self.numNodes20mmPeripheral
-
-            self.axoninterP = self.numberOfStinCompartmentsPerStretch*(self.numNodes20mmPeripheral)
-            self.axoninterC = self.numberOfStinCompartmentsPerStretch*(self.numNodes20mmCentral)
-            self.axonremaininginterP = self.numberOfStinCompartmentsPerVariableStretch*(self.remainingNodesPeripheral-1)
-            self.axonremaininginterC = self.numberOfStinCompartmentsPerVariableStretch*(self.remainingNodesCentral-1)
-
-            h('axoninterP = %i' % self.axoninterP)
-            h('axoninterC = %i' % self.axoninterC)
-            h('axonremaininginterP = %i' % self.axonremaininginterP)
-            h('axonremaininginterC = %i' % self.axonremaininginterC)
-            h('numNodes20mmPeripheral = %i' % self.numNodes20mmPeripheral)
-            h('numNodes20mmCentral = %i' % self.numNodes20mmCentral)
-
-        else:
-            h('variable_STIN = 0')
-            self.axoninterP = self.numberOfStinCompartmentsPerStretch*(self.axonnodesP-1)
-            self.axoninterC = self.numberOfStinCompartmentsPerStretch*(self.axonnodesC-1)
-            h('axoninterP = %i' % self.axoninterP)
-            h('axoninterC = %i' % self.axoninterC)
-
-
-        if (self.pain == True):
-            h('pain = 1')
-        else:
-            h('pain = 0')
-
-        # load node coordinates into hoc
-        h('objref nxC')
-        h('objref nxP')
-        h('objref nxT')
-        h('objref nyC')
-        h('objref nyP')
-        h('objref nyT')
-        h('objref nzC')
-        h('objref nzP')
-        h('objref nzT')
-        h('nxC = new Vector(%i)' % self.axonnodesC)
-        h('nxP = new Vector(%i)' % self.axonnodesP)
-        h('nxT = new Vector(%i)' % self.numStemCompartments)
-        h('nyC = new Vector(%i)' % self.axonnodesC)
-        h('nyP = new Vector(%i)' % self.axonnodesP)
-        h('nyT = new Vector(%i)' % self.numStemCompartments)
-        h('nzC = new Vector(%i)' % self.axonnodesC)
-        h('nzP = new Vector(%i)' % self.axonnodesP)
-        h('nzT = new Vector(%i)' % self.numStemCompartments)
-        for i in range(self.axonnodesC):
-            h.nxC.x[i] = self.NODE_COORDINATES_DR[i,0]
-            h.nyC.x[i] = self.NODE_COORDINATES_DR[i,1]
-            h.nzC.x[i] = self.NODE_COORDINATES_DR[i,2]
-        for i in range(self.axonnodesP):
-            h.nxP.x[i] = self.NODE_COORDINATES_PERIPHERAL[i,0]
-            h.nyP.x[i] = self.NODE_COORDINATES_PERIPHERAL[i,1]
-            h.nzP.x[i] = self.NODE_COORDINATES_PERIPHERAL[i,2]
-        for i in range(self.numStemCompartments):
-            h.nxT.x[i] = self.NODE_COORDINATES_STEM[i,0]
-            h.nyT.x[i] = self.NODE_COORDINATES_STEM[i,1]
-            h.nzT.x[i] = self.NODE_COORDINATES_STEM[i,2]
-
-        # account for normalized variable internode lengths to put in for STIN lengths
-        h('objref varLenP')
-        h('objref varLenC')
-        h('varLenP = new Vector(3)')
-        h('varLenC = new Vector(3)')
-        for ii in range(3):
-            h.varLenP.x[ii] = dxPeripheral[ii]
-            h.varLenC.x[ii] = dxDorsal[ii]
-
-        h.load_file(1, self.CELL_DIR+self.CELL_FILE_NAME)
-        self.endP = h.nodeP[self.axonnodesP-1] # end of peripheral axon
-        self.endC = h.nodeC[self.axonnodesC-1] # end of central axon
-        self.soma = h.soma # soma
-        self.TjuncStem = h.nodeT[0] # t-junction at stem axon
-        self.TjuncP = h.nodeP[0] # t-junction in peripheral axon
-        self.TjuncC = h.nodeC[0] # t-junction in central axon
-        self.midCentral = h.nodeC[int(self.axonnodesC/2)] # midway along central axon
-        self.midPeripheral = h.nodeP[int(self.axonnodesP/2)] # midway along peripheral axon
+        # load the cell template once per process and create this fiber's own instance of it
+        with self.profile_phase('load_file'):
+            self.hocCell = load_template(self.CELL_DIR+self.CELL_FILE_NAME)()
+
+        with self.profile_phase('parameters'):
+            # define necessary parameters
+            self.hocCell.fiberD_central = round(self.fiberD_central, 1)
+            self.hocCell.fiberD_peripheral = round(self.fiberD_peripheral, 1)
+            self.hocCell.fiberD_stem = round(self.fiberD_stem, 1)
+
+            # diameter dependent geometry and periaxonal resistances, computed once per diameter and shared by all fibers
+            self.hocCell.geometryC = h.Vector(mrg_parameters(self.fiberD_central, self.interpolate_diameter)['hoc'])
+            self.hocCell.geometryP = h.Vector(mrg_parameters(self.fiberD_peripheral, self.interpolate_diameter)['hoc'])
+            self.hocCell.geometryT = h.Vector(mrg_parameters(self.fiberD_stem, self.interpolate_diameter)['hoc'])
+            self.hocCell.numberOfStinCompartmentsPerStretch = self.numberOfStinCompartmentsPerStretch
+            self.hocCell.axonnodesP = self.axonnodesP
+            self.hocCell.axonnodesC = self.axonnodesC
+            self.hocCell.paranodes1P = self.paranodes1P
+            self.hocCell.paranodes1C = self.paranodes1C
+            self.hocCell.paranodes2P = self.paranodes2P
+            self.hocCell.paranodes2C = self.paranodes2C
+            self.hocCell.axonnodesT = self.axonnodesT
+            self.hocCell.paranodes1T = self.paranodes1T
+            self.hocCell.paranodes2T = self.paranodes2T
+            self.hocCell.axoninterT = self.axoninterT
+
+            self._set_internode_resolution(dxDorsal, dxPeripheral)
+            self._set_extracellular_region()
+
+            if (self.pain == True):
+                self.hocCell.pain = 1
+            else:
+                self.hocCell.pain = 0
+            self.hocCell.verbose = 1 if self.variables.get('verbose', False) else 0 # print the progress of connect_all
+
+            self._load_node_coordinates(dxDorsal, dxPeripheral)
+
+        self._build()
+        with self.profile_phase('define_geometry'):
+            self._define_geometry()
+        with self.profile_phase('extracellular'):
+            self._set_extracellular()
+        self.v_init = h.v_init # resting potential set by the template, used to initialize simulations of this fiber
+
+        self.endP = self.hocCell.nodeP[self.axonnodesP-1] # end of peripheral axon
+        self.endC = self.hocCell.nodeC[self.axonnodesC-1] # end of central axon
+        self.soma = self.hocCell.soma # soma
+        self.TjuncStem = self.hocCell.nodeT[0] # t-junction at stem axon
+        self.TjuncP = self.hocCell.nodeP[0] # t-junction in peripheral axon
+        self.TjuncC = self.hocCell.nodeC[0] # t-junction in central axon
+        self.midCentral = self.hocCell.nodeC[int(self.axonnodesC/2)] # midway along central axon
+        self.midPeripheral = self.hocCell.nodeP[int(self.axonnodesP/2)] # midway along peripheral axon
+        if self.metrics is not None:
+            self.metrics.count(self)
@@ -0,0 +1,196 @@
+# Code to apply extracellular potentials (e.g. from a stimulating electrode) to the sensory neuron models through e_extracellular
+
+from __future__ import division
+from neuron_runtime import h
+from numpy import array,asarray,concatenate,cumsum,errstate,fmax,fmin,full,interp,multiply,nan,pi,sqrt,zeros
+
+def segment_midpoints(cell):
+    '''
+    3D midpoints (um) of every segment of the cell, in the order of cell.get_secs(). Computed once per cell.
+    returns the segments and a (segments,3) array of midpoints
+    '''
+    if getattr(cell, '_segment_midpoints', None) is None:
+        secs = cell.get_secs()
+        table = cell.get_compartment_table()
+        if all(sec.nseg == 1 for sec in secs) and (len(table) == len(secs)) and (table['index'] >= 0).all():
+            # one segment per section, so these are the midpoints of the compartment table
+            midpoints = zeros((len(secs), 3))
+            midpoints[table['index']] = array([table['x'], table['y'], table['z']]).T
+            cell._segment_midpoints = ([sec(0.5) for sec in secs], midpoints)
+        else:
+            segs, midpoints = [], []
+            for sec in secs:
+                n3d = int(sec.n3d())
+                arc = [sec.arc3d(ii) for ii in range(n3d)]
+                xyz = [[sec.x3d(ii) for ii in range(n3d)], [sec.y3d(ii) for ii in range(n3d)], [sec.z3d(ii) for ii in range(n3d)]]
+                for seg in sec:
+                    segs.append(seg)
+                    midpoints.append([interp(seg.x*sec.L, arc, coordinate) for coordinate in xyz])
+            cell._segment_midpoints = (segs, array(midpoints))
+    return cell._segment_midpoints
+
+def point_source_coefficients(cell, electrode, conductivity=0.2):
+    '''
+    Extracellular potential (mV) at every segment midpoint per mA of a monopolar point source electrode in an
+    infinite homogeneous medium
+    electrode: (x,y,z) position in m, same frame as the trajectories
+    conductivity: S/m
+    '''
+    segs, midpoints = segment_midpoints(cell)
+    distance = sqrt(((midpoints*1e-6 - array(electrode))**2).sum(axis=1)) # m
+    return 1/(4*pi*conductivity*distance)
+
+def node_paths(cell):
+    '''
+    Node coordinates (m) of the peripheral, stem and central axon of a cell, each from the T-junction on
+    '''
+    return [array(cell.NODE_COORDINATES_PERIPHERAL[:cell.axonnodesP], dtype=float), array(cell.NODE_COORDINATES_STEM[:cell.axonnodesT], dtype=float),
+            array(cell.NODE_COORDINATES_DR[:cell.axonnodesC], dtype=float)]
+
+def activating_function(paths, electrodes, conductivity=0.2):
+    '''
+    Activating function of a point source electrode at the nodes of one or more axons: the second difference of
+    the extracellular potential along the nodes over the node spacing (mV/mm^2 per mA, positive where a positive
+    amplitude depolarizes). Every node and electrode position is evaluated in one pass.
+    paths: list of (nodes,3) node coordinates (m), e.g. from node_paths or find_devor_node_coordinates
+    electrodes: (electrodes,3) positions (m)
+    returns an (electrodes, nodes) array over the nodes of all paths one after the other, nan at the first and
+        last node of each path
+    '''
+    nodes = concatenate([asarray(path, dtype=float) for path in paths])
+    electrodes = asarray(electrodes, dtype=float).reshape(-1, 3)
+    potential = 1/(4*pi*conductivity*sqrt(((nodes[None,:,:]-electrodes[:,None,:])**2).sum(axis=2))) # mV per mA
+    spacing = sqrt(((nodes[1:]-nodes[:-1])**2).sum(axis=1))*1e3 # mm
+    d0, d1 = spacing[:-1], spacing[1:]
+
+    af = full(potential.shape, nan)
+    with errstate(divide='ignore', invalid='ignore'): # spacing across the end of one path and the start of the next
+        af[:,1:-1] = 2*(potential[:,:-2]/(d0*(d0+d1)) - potential[:,1:-1]/(d0*d1) + potential[:,2:]/(d1*(d0+d1)))
+    ends = cumsum([len(path) for path in paths])
+    af[:,ends-1] = nan
+    af[:,ends[:-1]] = nan
+    return af
+
+def activating_function_peaks(fibers, electrodes, conductivity=0.2, chunk=10**7):
+    '''
+    Largest and smallest activating function (mV/mm^2 per mA, see activating_function) over all nodes of every
+    fiber, for every electrode position. The peak a stimulus of amplitude I drives is max(I*largest, I*smallest).
+    fibers: list of node paths per fiber (see node_paths), or of cells
+    chunk: largest number of (electrode, node) values evaluated at once
+    returns two (fibers, electrodes) arrays, the largest and the smallest
+    '''
+    paths = [node_paths(fiber) if hasattr(fiber, 'hocCell') else fiber for fiber in fibers]
+    numNodes = [sum(len(path) for path in fiberPaths) for fiberPaths in paths]
+    starts = cumsum([0]+numNodes[:-1])
+    allPaths = [path for fiberPaths in paths for path in fiberPaths]
+    electrodes = asarray(electrodes, dtype=float).reshape(-1, 3)
+
+    largest, smallest = full((len(fibers), len(electrodes)), nan), full((len(fibers), len(electrodes)), nan)
+    step = max(1, int(chunk//max(1, sum(numNodes))))
+    for ii in range(0, len(electrodes), step):
+        af = activating_function(allPaths, electrodes[ii:ii+step], conductivity)
+        # fmax/fmin skip the nan at the ends of each path
+        largest[:,ii:ii+step] = fmax.reduceat(af, starts, axis=1).T
+        smallest[:,ii:ii+step] = fmin.reduceat(af, starts, axis=1).T
+    return largest, smallest
+
+def _point_to_elements(pointers, vectors, numSamples):
+    # pointers[ii*numSamples+jj] to vectors[ii].x[jj], set in hoc as Python would create a pointer object per element
+    if not h.name_declared('extracellular_point_to_elements'):
+        h('proc extracellular_point_to_elements() {local i, j  for i=0, $o2.count()-1 for j=0, $3-1 $o1.pset(i*$3+j, &$o2.o(i).x[j]) }')
+    rows = h.List()
+    for vec in vectors:
+        rows.append(vec)
+    h.extracellular_point_to_elements(pointers, rows, numSamples)
+
+class ExtracellularStimulus(object):
+    '''
+    Extracellular potential coefficient*amplitude*waveform(t), played into e_extracellular of every segment of a cell
+    that has the extracellular mechanism (see the extracellular_distance option of ABetaFiber/ADeltaFiber).
+
+    coefficients: potential (mV) per unit amplitude at every segment, in the order of segment_midpoints, e.g. from
+        point_source_coefficients or an FEM solution evaluated at the segment midpoints
+    The coefficients are fixed for the lifetime of the stimulus. The played waveforms of all segments are kept in one
+    (segments,samples) buffer, so changing the amplitude rescales them all in a single NumPy operation, scattered into
+    the played vectors in one call; changing the waveform only reallocates the vectors when its number of samples
+    changes. Nothing is recomputed per run or per time step. Only one stimulus plays into a cell at a time.
+    '''
+    def __init__(self, cell, coefficients):
+        self.cell = cell
+        self.segs, midpoints = segment_midpoints(cell)
+        self.coefficients = asarray(coefficients, dtype=float)
+        if len(self.coefficients) != len(self.segs): raise ValueError('Need one coefficient per segment (%i)!!!' % len(self.segs))
+        self.played = [ii for ii, seg in enumerate(self.segs) if seg.sec.has_membrane('extracellular')]
+        self.waveform = None
+        self.tvec = None
+        self.amplitude = 0.
+        self.playing = False
+
+    def set_waveform(self, waveform):
+        '''
+        waveform: (times (ms), normalized values), played with linear interpolation
+        '''
+        times, values = array(waveform[0], dtype=float), array(waveform[1], dtype=float)
+        if (self.waveform is not None) and (len(times) == len(self.waveform[0])) and (times == self.waveform[0]).all() and (values == self.waveform[1]).all():
+            return
+        self.waveform = (times, values)
+        if (self.tvec is not None) and (len(times) == self.tvec.size()):
+            # the played vectors keep their size, so they keep playing with their new contents
+            self.tvec.from_python(times)
+            self.set_amplitude(self.amplitude)
+            return
+        playing = self.playing
+        self.stop()
+        self.tvec = h.Vector(times)
+        self.vectors = [h.Vector(len(values)) for ii in self.played]
+        # the played waveforms, one row per played segment, and a pointer to every element of the played vectors
+        self.values = h.Vector(len(self.played)*len(values))
+        self.buffer = self.values.as_numpy().reshape(len(self.played), len(values))
+        self.pointers = h.PtrVector(len(self.values)) if len(self.played) else None # NEURON has no empty PtrVector
+        if self.pointers is not None:
+            _point_to_elements(self.pointers, self.vectors, len(values))
+        self.set_amplitude(self.amplitude)
+        if playing:
+            self.play()
+
+    def set_amplitude(self, amplitude):
+        self.amplitude = amplitude
+        if self.waveform is None:
+            return
+        multiply.outer(amplitude*self.coefficients[self.played], self.waveform[1], out=self.buffer)
+        if self.pointers is not None:
+            self.pointers.scatter(self.values)
+
+    def play(self):
+        if self.waveform is None: raise ValueError('Need to set a waveform before playing the stimulus!!!')
+        if self.playing:
+            return
+        active = getattr(self.cell, '_extracellular_stimulus', None)
+        if active is not None:
+            active.stop()
+        for vec, ii in zip(self.vectors, self.played):
+            vec.play(self.segs[ii]._ref_e_extracellular, self.tvec, 1)
+        self.cell._extracellular_stimulus = self
+        self.playing = True
+
+    def stop(self):
+        if not self.playing:
+            return
+        for vec, ii in zip(self.vectors, self.played):
+            vec.play_remove()
+            self.segs[ii].e_extracellular = 0
+        self.cell._extracellular_stimulus = None
+        self.playing = False
+
+def point_source_stimulus(cell, electrode, conductivity=0.2):
+    '''
+    ExtracellularStimulus of a point source electrode. The stimulus of the last electrode position is kept on the cell,
+    so repeated runs at the same position (e.g. a threshold search) reuse its coefficients and vectors.
+    '''
+    key = (tuple(electrode), conductivity)
+    cached = getattr(cell, '_point_source_stimulus', None)
+    if (cached is None) or (cached[0] != key):
+        if cached is not None:
+            cached[1].stop()
+        cell._point_source_stimulus = (key, ExtracellularStimulus(cell, point_source_coefficients(cell, electrode, conductivity)))
+    return cell._point_source_stimulus[1]
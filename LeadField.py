@@ -0,0 +1,98 @@
+# Code to precompute the lead field of a set of electrode contacts over a fiber population and keep it memory-mapped on disk, for sweeps over contact configurations
+
+from __future__ import division
+from numpy import asarray,concatenate,cumsum,load,pi,savez,sqrt
+from numpy.lib.format import open_memmap
+from Extracellular import ExtracellularStimulus, segment_midpoints
+
+import os
+import tempfile
+
+class LeadFieldStore(object):
+    '''
+    Potential (mV) per mA of unit current through every contact, at every segment midpoint (see
+    Extracellular.segment_midpoints) of every fiber of a population, built once (LeadFieldStore.build) and then
+    memory-mapped read only. The potentials are one (contacts, segments) array over the segments of all fibers one
+    after the other, so each contact is a contiguous row; any configuration of contact currents is a weighted sum of
+    rows, and workers that open the same directory share the pages instead of computing or receiving fields.
+
+    directory: where build() wrote the store
+    A store pickles as its directory, so it can be handed to worker processes, which map it again.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        with load(os.path.join(directory, 'index.npz')) as index:
+            self.offsets = index['offsets']
+            self.contacts = index['contacts']
+            self.conductivity = float(index['conductivity'])
+        self.potentials = load(os.path.join(directory, 'potentials.npy'), mmap_mode='r')
+        if self.potentials.shape != (len(self.contacts), self.offsets[-1]): raise ValueError('Lead field in %s does not match its index!!!' % directory)
+
+    def __getstate__(self):
+        return {'directory': self.directory}
+
+    def __setstate__(self, state):
+        self.__init__(state['directory'])
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    @staticmethod
+    def build(directory, fibers, contacts, conductivity=0.2, potential=None, chunk=10**7):
+        '''
+        Compute and store the lead field of contacts over fibers, overwriting any store in directory
+        fibers: built ABetaFiber/ADeltaFiber cells, e.g. a FiberPopulation
+        contacts: (contacts,3) positions (m), same frame as the trajectories
+        conductivity: S/m, of the infinite homogeneous medium of the default point source field
+        potential: function(contact index, (segments,3) midpoints (m)) returning the potentials (mV per mA) of that
+            contact, e.g. an interpolated FEM solution, instead of the point source field
+        chunk: largest number of (contact, segment) values computed at once
+        returns the LeadFieldStore
+        '''
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        contacts = asarray(contacts, dtype=float).reshape(-1, 3)
+        midpoints = [segment_midpoints(fiber)[1]*1e-6 for fiber in fibers] # m
+        offsets = concatenate([[0], cumsum([len(points) for points in midpoints])])
+
+        # written under temporary names and renamed, so readers never map a partial store
+        handle, temporary = tempfile.mkstemp(dir=directory, suffix='.npy')
+        os.close(handle)
+        potentials = open_memmap(temporary, mode='w+', dtype=float, shape=(len(contacts), int(offsets[-1])))
+        for points, start, end in zip(midpoints, offsets[:-1], offsets[1:]):
+            if potential is not None:
+                for ii in range(len(contacts)):
+                    potentials[ii, start:end] = potential(ii, points)
+                continue
+            step = max(1, int(chunk//max(1, len(points))))
+            for ii in range(0, len(contacts), step):
+                distance = sqrt(((points[None,:,:] - contacts[ii:ii+step,None,:])**2).sum(axis=2))
+                potentials[ii:ii+step, start:end] = 1/(4*pi*conductivity*distance)
+        potentials.flush()
+        del potentials
+        os.replace(temporary, os.path.join(directory, 'potentials.npy'))
+
+        handle, temporary = tempfile.mkstemp(dir=directory, suffix='.npz')
+        with os.fdopen(handle, 'wb') as output:
+            savez(output, offsets=offsets, contacts=contacts, conductivity=conductivity)
+        os.replace(temporary, os.path.join(directory, 'index.npz'))
+        return LeadFieldStore(directory)
+
+    def coefficients(self, fiberIndex, weights):
+        '''
+        Potential (mV) at every segment of one fiber per unit amplitude of a contact configuration
+        weights: current (mA) through every contact per unit amplitude, e.g. [1, -1, 0, ...] for a bipole
+        returns a (segments,) array, in the order of segment_midpoints
+        '''
+        weights = asarray(weights, dtype=float)
+        if len(weights) != len(self.contacts): raise ValueError('Need one weight per contact (%i)!!!' % len(self.contacts))
+        start, end = self.offsets[fiberIndex], self.offsets[fiberIndex+1]
+        used = weights.nonzero()[0] # only the rows of the active contacts are read
+        return weights[used].dot(self.potentials[used, start:end])
+
+    def stimulus(self, cell, fiberIndex, weights):
+        '''
+        ExtracellularStimulus of a contact configuration (see coefficients) on cell, the fiber fiberIndex of the
+        population the store was built for
+        '''
+        return ExtracellularStimulus(cell, self.coefficients(fiberIndex, weights))
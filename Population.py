@@ -0,0 +1,328 @@
+# Code to build whole populations of ABeta/ADelta sensory neurons (e.g. a dorsal root ganglion) into one NEURON model
+
+from __future__ import division
+from neuron_runtime import h, load_mechanisms, load_template, neuron_version
+from numpy import argsort,array,concatenate,shape,zeros
+from Cell import ELECTRODE_DISTANCE, FINE_DISTANCE, ABetaFiber, ADeltaFiber, fine_internodes
+from fiber_parameters import celsius
+from Extracellular import point_source_stimulus
+from Profiling import FiberMetrics, population_report, resident_memory
+from Recording import LANDMARKS
+from find_node_coordinates import find_devor_node_coordinates_batch
+
+from contextlib import nullcontext
+import time
+
+class FiberPopulation(object):
+    '''
+    Population of ABeta and ADelta fibers built into a single NEURON model.
+
+    Per fiber arguments are sequences with one entry per fiber; fiberD_*, pain, fiber_type and variable_STIN
+    may also be given once for the whole population. Mechanisms and cell templates are loaded once, and the
+    dorsal and peripheral nodes of all fibers are placed together before any fiber is built.
+
+    electrode, extracellular_distance: passed on to every fiber, see Cell._set_extracellular_region
+    fine_distance, electrode_distance: passed on to every fiber, with electrode they set the fully resolved internodes
+    of variable_STIN fibers, see Cell.fine_internodes
+    celsius: degC, temperature of every fiber (37 by default); NEURON has a single temperature, so the fibers of a
+    population are simulated together at one
+    verbose: let every fiber print the progress of connecting its sections, off by default
+    profile: build every fiber with profile=True (see Cell.profile_phase) and time the node placement, initialization
+    and runs of the whole population, see profile_report
+    '''
+    def __init__(self,**kwargs):
+        self.variables = kwargs
+        if 'peripheral_trajectories' not in self.variables: raise TypeError('Need to specify peripheral axon trajectories!!!')
+        if 'dorsal_trajectories' not in self.variables: raise TypeError('Need to specify dorsal axon trajectories!!!')
+        if 'stem_trajectories' not in self.variables: raise TypeError('Need to specify stem axon trajectories!!!')
+        if 'fiberD_central' not in self.variables:  raise TypeError('Need to specify central axon diameters!!!')
+        if 'fiberD_peripheral' not in self.variables:  raise TypeError('Need to specify peripheral axon diameters!!!')
+        if 'fiberD_stem' not in self.variables:  raise TypeError('Need to specify stem axon diameters!!!')
+        if 'pain' not in self.variables: raise TypeError('Need to specify which fibers are painful!!!')
+        if 'CELL_DIR' not in self.variables: raise TypeError('Need to specify path to cell files!!!')
+
+        self.peripheral_trajectories = list(self.variables['peripheral_trajectories'])
+        self.dorsal_trajectories = list(self.variables['dorsal_trajectories'])
+        self.stem_trajectories = list(self.variables['stem_trajectories'])
+        self.numFibers = len(self.peripheral_trajectories)
+        if (len(self.dorsal_trajectories) != self.numFibers) or (len(self.stem_trajectories) != self.numFibers):
+            raise ValueError('Need one peripheral, dorsal and stem trajectory per fiber!!!')
+
+        self.fiberD_central = self._per_fiber('fiberD_central')
+        self.fiberD_peripheral = self._per_fiber('fiberD_peripheral')
+        self.fiberD_stem = self._per_fiber('fiberD_stem')
+        self.pain = self._per_fiber('pain')
+        self.fiber_type = self._per_fiber('fiber_type', 'ABeta') # 'ABeta' or 'ADelta'
+        self.variable_STIN = self._per_fiber('variable_STIN', False)
+        self.interpolate_diameter = self.variables.get('interpolate_diameter', False) # allow diameters between the tabulated MRG ones
+        self.electrode = self.variables.get('electrode') # (x,y,z) in m
+        self.fine_distance = self.variables.get('fine_distance', FINE_DISTANCE) # m
+        self.electrode_distance = self.variables.get('electrode_distance', ELECTRODE_DISTANCE) # m
+        self.celsius = self.variables.get('celsius', celsius) # degC, see initialize
+        self.CELL_DIR = self.variables['CELL_DIR']
+        self.CELL_FILE_NAMES = {'ABeta': 'ABetaFiber.hoc', 'ADelta': 'ADeltaFiber_LTMR.hoc'}
+        self.CELL_FILE_NAMES.update(self.variables.get('CELL_FILE_NAMES', {}))
+        self.profile = self.variables.get('profile', False)
+        self.metrics = FiberMetrics() if self.profile else None # phases of the whole population
+
+        for fiber_type in set(self.fiber_type):
+            if fiber_type not in self.CELL_FILE_NAMES: raise ValueError('Unknown fiber type %s, choose from ABeta or ADelta!!!' % fiber_type)
+
+        self._construct_population()
+
+    def __str__(self):
+        return "DRG Fiber Population (%i fibers)" % self.numFibers
+
+    def __len__(self):
+        return self.numFibers
+
+    def __getitem__(self, ii):
+        return self.fibers[ii]
+
+    def __iter__(self):
+        return iter(self.fibers)
+
+    def _phase(self, name):
+        return self.metrics.phase(name) if self.metrics is not None else nullcontext()
+
+    def _per_fiber(self, name, default=None):
+        value = self.variables.get(name, default)
+        if shape(value) == ():
+            value = [value]*self.numFibers
+        if len(value) != self.numFibers: raise ValueError('Need one %s per fiber!!!' % name)
+        return list(value)
+
+    def _construct_population(self):
+        # shared setup, done once for all fibers
+        if 'MECHANISM_DIR' in self.variables:
+            load_mechanisms(self.variables['MECHANISM_DIR'])
+        for fiber_type in set(self.fiber_type):
+            load_template(self.CELL_DIR+self.CELL_FILE_NAMES[fiber_type])
+
+        # place the dorsal and peripheral nodes of the whole population in one pass
+        t0 = time.time()
+        with self._phase('node_placement'):
+            dorsal = find_devor_node_coordinates_batch(self.dorsal_trajectories, 'dorsal', 'hybrid', self.fiberD_central, self.interpolate_diameter)
+            peripheral = find_devor_node_coordinates_batch(self.peripheral_trajectories, 'peripheral', 'hybrid', self.fiberD_peripheral, self.interpolate_diameter)
+        self.node_placement_time = time.time() - t0
+
+        self.fibers = []
+        self.gids = self._assign_fibers(dorsal, peripheral) # population indices of the fibers built here
+        self.build_time = []
+        self.build_memory = []
+        self.numSections = []
+        for ii in self.gids:
+            arguments = dict(peripheral_trajectory=self.peripheral_trajectories[ii], dorsal_trajectory=self.dorsal_trajectories[ii],
+                             stem_trajectory=self.stem_trajectories[ii], fiberD_central=self.fiberD_central[ii],
+                             fiberD_peripheral=self.fiberD_peripheral[ii], fiberD_stem=self.fiberD_stem[ii], pain=self.pain[ii],
+                             CELL_DIR=self.CELL_DIR, CELL_FILE_NAME=self.CELL_FILE_NAMES[self.fiber_type[ii]], interpolate_diameter=self.interpolate_diameter, profile=self.profile,
+                             celsius=self.celsius,
+                             verbose=self.variables.get('verbose', False),
+                             electrode=self.electrode, extracellular_distance=self.variables.get('extracellular_distance'),
+                             fine_distance=self.fine_distance, electrode_distance=self.electrode_distance,
+                             node_coordinates=((dorsal[0][ii], dorsal[1][ii]), (peripheral[0][ii], peripheral[1][ii])))
+
+            memory0, t0 = resident_memory(), time.time()
+            if self.fiber_type[ii] == 'ABeta':
+                fiber = ABetaFiber(variable_STIN=self.variable_STIN[ii], **arguments)
+            else:
+                fiber = ADeltaFiber(variable_STIN=self.variable_STIN[ii], **arguments)
+            self.build_time.append(time.time() - t0)
+            self.build_memory.append(resident_memory() - memory0)
+            self.numSections.append(len(fiber.get_secs()))
+            self.fibers.append(fiber)
+
+        self.build_time = array(self.build_time)
+        self.build_memory = array(self.build_memory)
+        self.numSections = array(self.numSections)
+
+    def _assign_fibers(self, dorsal, peripheral):
+        return list(range(self.numFibers))
+
+    def set_threads(self, numThreads, cache_efficient=True):
+        '''
+        Integrate the fibers on numThreads threads of this process (ParallelContext.nthread). Whole fibers are dealt
+        out largest first to the thread with the fewest segments so far, so long peripheral axons do not end up on
+        one thread. cache_efficient: keep the node data of each thread contiguous in memory (CVode.cache_efficient)
+        NEURON (9.0 among others) integrates a model on a single thread as soon as any section of the process has the
+        extracellular mechanism. Fibers built the default way have it everywhere, so they can never run on more than
+        one thread; build them with electrode and an extracellular_distance (see Cell._set_extracellular_region) that
+        leaves every compartment without it, and stimulate them intracellularly. Otherwise the fibers stay on one
+        thread and a ValueError is raised.
+        returns the number of segments per thread
+        '''
+        pc = h.ParallelContext()
+        pc.nthread(numThreads)
+        segments = array([len(fiber.segments()) for fiber in self.fibers], dtype=int)
+        self.thread_load = zeros(numThreads, dtype=int)
+        roots = [h.SectionList() for ii in range(numThreads)]
+        for ii in argsort(-segments, kind='stable'):
+            thread = self.thread_load.argmin()
+            roots[thread].append(sec=h.SectionRef(sec=self.fibers[ii].TjuncStem).root)
+            self.thread_load[thread] += segments[ii]
+        if numThreads > 1:
+            for thread in range(numThreads):
+                pc.partition(thread, roots[thread])
+        h.CVode().cache_efficient(1 if cache_efficient else 0)
+        try:
+            h.finitialize()
+        except RuntimeError:
+            pc.nthread(1)
+            self.thread_load = array([segments.sum()])
+            raise ValueError('NEURON %s cannot integrate these fibers on several threads (see its messages above)!!!' % neuron_version())
+        return self.thread_load
+
+    def stimulate(self, amplitude, waveform, electrode, conductivity=0.2):
+        '''
+        Apply amplitude*waveform through a point source electrode to every fiber, see Simulation.record_spikes
+        '''
+        for fiber in self.fibers:
+            stimulus = point_source_stimulus(fiber, electrode, conductivity)
+            stimulus.set_waveform(waveform)
+            stimulus.set_amplitude(amplitude)
+            stimulus.play()
+
+    def initialize(self):
+        '''
+        Initialize a simulation of all fibers at once, each at its own resting state: its steady_state if it has
+        one (see Cell.settle), v_init otherwise, at the celsius of the population
+        '''
+        for fiber in self.fibers:
+            if fiber.celsius != self.celsius: raise ValueError('Fiber at %g degC in a population at %g degC, NEURON simulates all fibers at one temperature!!!' % (fiber.celsius, self.celsius))
+        with self._phase('initialize'):
+            h.celsius = self.celsius
+            for fiber in self.fibers:
+                if fiber.steady_state is None:
+                    for seg in fiber.segments():
+                        seg.v = fiber.v_init
+                else:
+                    for seg, v in zip(fiber.segments(), fiber.steady_state):
+                        seg.v = v
+            h.finitialize()
+
+    def run(self, tstop=5, dt=0.005):
+        '''
+        Run all fibers from their resting state (see initialize) to tstop (ms), on the threads of set_threads
+        '''
+        h.dt = dt
+        self.initialize()
+        with self._phase('run'):
+            h.continuerun(tstop)
+
+    def report(self):
+        '''
+        Build time (s) and memory (bytes) of the population, in total and per fiber
+        '''
+        return {'numFibers': self.numFibers,
+                'numSections': int(self.numSections.sum()),
+                'node_placement_time': self.node_placement_time,
+                'build_time': float(self.build_time.sum()),
+                'build_time_per_fiber': float(self.build_time.mean()) if len(self.fibers) else 0.,
+                'build_memory': int(self.build_memory.sum()),
+                'build_memory_per_fiber': float(self.build_memory.mean()) if len(self.fibers) else 0.}
+
+    def profile_report(self):
+        '''
+        Where the time of a population built with profile=True goes: the phases of its fibers aggregated over all
+        fibers (see Profiling.population_report), with those of the whole population (node placement of all fibers,
+        initialization and runs) under 'population'
+        '''
+        if self.metrics is None: raise ValueError('Need to build the population with profile=True!!!')
+        return dict(population_report([fiber.metrics for fiber in self.fibers]), population=self.metrics.as_dict())
+
+def compartment_counts(nodes, dxs, variable_STIN, fine_distance=FINE_DISTANCE, electrode=None, electrode_distance=ELECTRODE_DISTANCE, nstins=6):
+    '''
+    Number of compartments the templates create for the peripheral or central axons of a batch of fibers, from their
+    placed nodes and internode lengths (see find_devor_node_coordinates_batch) and the fully resolved internodes the
+    fibers are built with (see Cell.fine_internodes)
+    '''
+    counts = zeros(len(nodes), dtype=int)
+    for ii, (axonNodes, dx, variable) in enumerate(zip(nodes, dxs, variable_STIN)):
+        numInter = len(axonNodes)-1
+        numFine = fine_internodes(axonNodes, dx, fine_distance, electrode, electrode_distance) if variable else numInter
+        counts[ii] = len(axonNodes) + 4*numInter + nstins*numFine + (numInter-numFine)
+    return counts
+
+class DistributedFiberPopulation(FiberPopulation):
+    '''
+    FiberPopulation spread over the ranks of an MPI job through h.ParallelContext (e.g. mpiexec -n 4 python
+    script.py), or built whole in a single process without MPI. Every rank places the nodes of all fibers, which is
+    cheap, and builds only its share of them: fibers are dealt out largest first to the rank with the fewest
+    compartments so far. Each fiber is a gid, its index in the population, with an action potential detector at
+    one of its nodes, and the detected action potential times of all ranks are gathered to rank 0.
+
+    Additional arguments: detect_at, the node to detect action potentials at (see Recording.LANDMARKS, endC by
+    default), threshold (mV, -20 by default)
+    Unlike FiberPopulation, fibers, gids and the build statistics only cover the fibers of this rank.
+    '''
+    def __init__(self,**kwargs):
+        h.nrnmpi_init()
+        self.pc = h.ParallelContext()
+        self.rank, self.numRanks = int(self.pc.id()), int(self.pc.nhost())
+        self.detect_at = kwargs.get('detect_at', 'endC')
+        self.threshold = kwargs.get('threshold', -20) # mV
+        if self.detect_at not in LANDMARKS: raise ValueError('Unknown node %s, choose from %s!!!' % (self.detect_at, ', '.join(LANDMARKS)))
+        super(DistributedFiberPopulation, self).__init__(**kwargs)
+
+    def __str__(self):
+        return "DRG Fiber Population (%i of %i fibers on rank %i of %i)" % (len(self.fibers), self.numFibers, self.rank, self.numRanks)
+
+    def _assign_fibers(self, dorsal, peripheral):
+        # the same on every rank, as every rank placed the same nodes; the stem axon and soma, alike in every fiber,
+        # are left out of the compartment counts
+        resolution = dict(fine_distance=self.fine_distance, electrode=self.electrode, electrode_distance=self.electrode_distance)
+        self.compartments = (compartment_counts(dorsal[0], dorsal[1], self.variable_STIN, **resolution) +
+                             compartment_counts(peripheral[0], peripheral[1], self.variable_STIN, **resolution))
+        self.ranks = zeros(self.numFibers, dtype=int)
+        load = zeros(self.numRanks, dtype=int)
+        for ii in argsort(-self.compartments, kind='stable'):
+            self.ranks[ii] = load.argmin()
+            load[self.ranks[ii]] += self.compartments[ii]
+        self.load = load
+        return [ii for ii in range(self.numFibers) if self.ranks[ii] == self.rank]
+
+    def _construct_population(self):
+        super(DistributedFiberPopulation, self)._construct_population()
+        self.netcons = []
+        for gid, fiber in zip(self.gids, self.fibers):
+            sec = getattr(fiber, self.detect_at)
+            self.pc.set_gid2node(gid, self.rank)
+            nc = h.NetCon(sec(0.5)._ref_v, None, sec=sec)
+            nc.threshold = self.threshold
+            self.pc.cell(gid, nc)
+            self.netcons.append(nc)
+        self.spike_times, self.spike_gids = h.Vector(), h.Vector()
+        self.pc.spike_record(-1, self.spike_times, self.spike_gids)
+
+    def run(self, tstop=5, dt=0.005):
+        '''
+        Run every rank from the resting state of its fibers to tstop (ms), see FiberPopulation.initialize. There are
+        no connections between fibers, so the ranks only meet at the end.
+        '''
+        h.dt = dt
+        self.pc.set_maxstep(10)
+        self.initialize()
+        self.spike_times.resize(0)
+        self.spike_gids.resize(0)
+        with self._phase('run'):
+            self.pc.psolve(tstop)
+
+    def spikes(self):
+        '''
+        Action potential times of the last run gathered from all ranks (a collective call, every rank has to make it)
+        returns on rank 0 the times (ms) in time order and the gid of each, None on the other ranks
+        '''
+        gathered = self.pc.py_gather((self.spike_times.to_python(), self.spike_gids.to_python()), 0)
+        if self.rank != 0:
+            return None
+        times = concatenate([array(tt, dtype=float) for tt, gg in gathered])
+        gids = concatenate([array(gg, dtype=int) for tt, gg in gathered])
+        order = argsort(times, kind='stable')
+        return times[order], gids[order]
+
+    def done(self):
+        '''
+        End the parallel part of the job, on every rank
+        '''
+        self.pc.barrier()
+        self.pc.done()
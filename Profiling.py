@@ -0,0 +1,109 @@
+# Code to profile the sensory neuron models: wall time and memory of each phase of building and simulating a fiber, and a report over a population
+
+from __future__ import division
+from neuron_runtime import h
+from numpy import array
+
+from contextlib import contextmanager
+import resource
+import time
+import tracemalloc
+
+# phases of ABetaFiber/ADeltaFiber, in the order they happen
+PHASES = ('node_placement', 'parameters', 'load_file', 'buildCell', 'connect_all', 'define_geometry', 'extracellular', 'initialize', 'run')
+
+def resident_memory():
+    '''
+    Resident memory of this process (bytes). Uses /proc on Linux and the peak resident memory elsewhere.
+    '''
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class FiberMetrics(object):
+    '''
+    Wall time and memory of the phases of one fiber (see PHASES), and its size once built. Calls of the same phase
+    add up, e.g. every run of the fiber goes into 'run', and run_times keeps them one by one.
+
+    memory is the growth of the resident memory of the process, which covers what NEURON allocates. python_memory is
+    the peak of the Python allocations within the phase, only measured while tracemalloc is tracing (e.g. after
+    tracemalloc.start()).
+    '''
+    def __init__(self):
+        self.phases = {}
+        self.run_times = []
+        self.counts = {}
+
+    @contextmanager
+    def phase(self, name):
+        '''
+        Context manager adding the time and memory spent within it to phase name
+        '''
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            python0 = tracemalloc.get_traced_memory()[0]
+        memory0, t0 = resident_memory(), time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - t0
+            totals = self.phases.setdefault(name, {'calls': 0, 'time': 0., 'memory': 0, 'python_memory': 0})
+            totals['calls'] += 1
+            totals['time'] += elapsed
+            totals['memory'] += resident_memory() - memory0
+            if tracing:
+                totals['python_memory'] = max(totals['python_memory'], tracemalloc.get_traced_memory()[1] - python0)
+            if name == 'run':
+                self.run_times.append(elapsed)
+
+    def count(self, cell):
+        '''
+        Number of sections and segments of a built cell, and of those with the extracellular mechanism and its layers
+        '''
+        secs = cell.get_secs()
+        extracellular = [sec for sec in secs if sec.has_membrane('extracellular')]
+        self.counts = {'sections': len(secs), 'segments': sum(sec.nseg for sec in secs),
+                       'extracellular_sections': len(extracellular),
+                       'extracellular_layers': sum(sec.nseg for sec in extracellular)*int(h.nlayer_extracellular())}
+
+    def time(self, name):
+        '''
+        returns the total time (s) of phase name, 0 if it never ran
+        '''
+        return self.phases.get(name, {}).get('time', 0.)
+
+    def as_dict(self):
+        '''
+        returns the phases, in PHASES order and then any other, the run times and the counts as plain Python types
+        '''
+        names = [name for name in PHASES if name in self.phases] + sorted(set(self.phases) - set(PHASES))
+        return {'phases': dict((name, dict(self.phases[name])) for name in names),
+                'run_times': list(self.run_times), 'counts': dict(self.counts)}
+
+def population_report(metrics):
+    '''
+    Aggregate of the FiberMetrics of many fibers: for every phase the total, mean and largest time (s) per fiber,
+    its share of the total time and the total memory (bytes), and the totals of the counts
+    metrics: FiberMetrics, None entries (fibers built without profiling) are left out
+    returns a dictionary with the number of profiled fibers, 'phases' and 'counts'
+    '''
+    metrics = [fiber for fiber in metrics if fiber is not None]
+    names = [name for name in PHASES if any(name in fiber.phases for fiber in metrics)]
+    names += sorted(set(name for fiber in metrics for name in fiber.phases) - set(names))
+    total = sum(fiber.time(name) for fiber in metrics for name in names)
+
+    phases = {}
+    for name in names:
+        times = array([fiber.time(name) for fiber in metrics])
+        phases[name] = {'time': float(times.sum()), 'mean': float(times.mean()), 'max': float(times.max()),
+                        'share': float(times.sum()/total) if total else 0.,
+                        'memory': int(sum(fiber.phases.get(name, {}).get('memory', 0) for fiber in metrics)),
+                        'calls': int(sum(fiber.phases.get(name, {}).get('calls', 0) for fiber in metrics))}
+    counts = {}
+    for fiber in metrics:
+        for name, value in fiber.counts.items():
+            counts[name] = counts.get(name, 0) + value
+    return {'numFibers': len(metrics), 'phases': phases, 'counts': counts}
@@ -0,0 +1,130 @@
+# Code to analyse how action potentials travel along whole populations of fibers: initiation site, conduction velocities, T-junction failure and somatic invasion, in NumPy over all fibers at once
+
+from __future__ import division
+from numpy import arange,array,bincount,concatenate,cumsum,diff,fmin,full,isfinite,nan,repeat,sqrt,unique,where
+from Extracellular import node_paths
+
+# axons of ABetaFiber/ADeltaFiber in the order of Recording.node_sections, as coded in the region column
+REGIONS = ('P', 'T', 'C')
+
+def node_positions(paths):
+    '''
+    Path distance (m) of every node from the T-junction along its axon, and the region (index in REGIONS) of every node
+    paths: node coordinates (m) of the peripheral, stem and central axon, each from the T-junction outwards, e.g. from
+        Simulation.fiber_node_paths or Extracellular.node_paths
+    returns two arrays with the nodes of the three axons one after the other
+    '''
+    positions, regions = [], []
+    for region, nodes in enumerate(paths):
+        nodes = array(nodes, dtype=float).reshape(-1, 3)
+        positions.append(concatenate([[0.], cumsum(sqrt((diff(nodes, axis=0)**2).sum(axis=1)))]))
+        regions.append(full(len(nodes), region, dtype='i1'))
+    return concatenate(positions), concatenate(regions)
+
+def fiber_spikes(cell, recorder):
+    '''
+    Compact record of one fiber for stack: the first action potential time (ms, nan where there was none) at every
+    node with its position and region (see node_positions), and at the soma
+    recorder: Recording.SpikeRecorder of the cell with nodes='propagation', e.g. from
+        Simulation.record_spikes(..., nodes='propagation')
+    returns a dictionary of plain arrays, small enough to send back from worker processes
+    '''
+    if recorder.names[-1] != 'soma': raise ValueError('Need a SpikeRecorder with nodes=\'propagation\'!!!')
+    position, region = node_positions(node_paths(cell))
+    times = recorder.first_spikes()
+    if len(times) != len(position)+1: raise ValueError('SpikeRecorder does not match the nodes of the cell!!!')
+    return {'time': times[:-1], 'position': position, 'region': region, 'soma': times[-1]}
+
+def stack(fibers):
+    '''
+    The records of many fibers (see fiber_spikes) as one set of arrays: time, position and region of all their
+    nodes one fiber after the other, the nodes of fiber ii being offsets[ii]:offsets[ii+1], and soma, one time per fiber
+    '''
+    fibers = list(fibers)
+    return {'offsets': concatenate([[0], cumsum([len(fiber['time']) for fiber in fibers])]).astype(int),
+            'time': concatenate([fiber['time'] for fiber in fibers]),
+            'position': concatenate([fiber['position'] for fiber in fibers]),
+            'region': concatenate([fiber['region'] for fiber in fibers]),
+            'soma': array([fiber['soma'] for fiber in fibers], dtype=float)}
+
+def analyze(spikes, delay=0., exclude=1e-3):
+    '''
+    Propagation of the action potentials of every fiber of stack(...), computed for all fibers at once
+    delay: ms, onset of the stimulus, latencies are from it
+    exclude: m, nodes within this path distance of the initiation site are left out of the conduction velocities,
+        as near the electrode they are depolarized by the stimulus rather than reached by the action potential
+    returns a dictionary of arrays with one entry per fiber:
+        initiation: index of the node within the fiber (in the order of node_sections('propagation')) where the
+            first action potential occurred, -1 if there was none
+        initiation_region: index in REGIONS of that node, -1 if none
+        initiation_position: m, its path distance from the T-junction
+        initiation_latency: ms, from the stimulus onset
+        velocity: (fibers,3) conduction velocity (m/s) in the peripheral, stem and central axon, from a least
+            squares fit of the path distance from the initiation site against the action potential times of the
+            nodes of that axon, nan with fewer than two nodes to fit
+        reached_junction: whether the action potential reached the T-junction on the side it was initiated on (only
+            for an initiation in the peripheral or central axon)
+        crossed: whether it went on to the far end of the other axon (endC for a peripheral initiation, endP for a
+            central one), i.e. passed through the T-junction
+        junction_failure: reached the T-junction but did not cross it
+        junction_delay: ms, from the T-junction node of the initiating axon to that of the other axon
+        soma_invaded: whether an action potential reached the soma
+        soma_latency: ms, of the soma from the stimulus onset
+        invasion_time: ms, from the initiation to the soma
+    '''
+    offsets, time, position, region = spikes['offsets'], spikes['time'], spikes['position'], spikes['region']
+    numFibers = len(offsets)-1
+    counts = diff(offsets)
+    fiber = repeat(arange(numFibers), counts)
+    fired = isfinite(time)
+
+    # initiation site: the first node of each fiber with its earliest time
+    first = full(numFibers, nan)
+    nonEmpty = counts > 0
+    first[nonEmpty] = fmin.reduceat(time, offsets[:-1][nonEmpty])
+    earliest = (fired & (time == first[fiber])).nonzero()[0]
+    fibersFired, firstIndex = unique(fiber[earliest], return_index=True)
+    initiation = full(numFibers, -1)
+    initiation[fibersFired] = earliest[firstIndex]
+    started = initiation >= 0
+    initiationRegion = full(numFibers, -1)
+    initiationRegion[started] = region[initiation[started]]
+    initiationPosition = full(numFibers, nan)
+    initiationPosition[started] = position[initiation[started]]
+
+    # path distance of every node from the initiation site: along the axon it is on, or through the T-junction
+    distance = where(region == initiationRegion[fiber], abs(position - initiationPosition[fiber]), position + initiationPosition[fiber])
+    used = fired & started[fiber] & (distance >= exclude)
+    group = (fiber*len(REGIONS) + region)[used]
+    t, x, size = time[used], distance[used], numFibers*len(REGIONS)
+    n = bincount(group, minlength=size)
+    St, Sx = bincount(group, t, size), bincount(group, x, size)
+    Stt, Stx = bincount(group, t*t, size), bincount(group, t*x, size)
+    denominator = n*Stt - St**2
+    velocity = full(size, nan)
+    fit = (n >= 2) & (denominator > 1e-12*n*n)
+    velocity[fit] = (n*Stx - St*Sx)[fit]/denominator[fit]*1e3 # m/ms to m/s
+    velocity = velocity.reshape(numFibers, len(REGIONS))
+
+    # the peripheral axon comes first and the central axon last within each fiber, both from the T-junction outwards
+    numP = bincount(fiber[region == REGIONS.index('P')], minlength=numFibers)
+    numC = bincount(fiber[region == REGIONS.index('C')], minlength=numFibers)
+    tjuncP, endP = where(numP > 0, offsets[:-1], -1), where(numP > 0, offsets[:-1] + numP - 1, -1)
+    tjuncC, endC = where(numC > 0, offsets[1:] - numC, -1), where(numC > 0, offsets[1:] - 1, -1)
+    timeAt = lambda nodes: where(nodes >= 0, time[nodes.clip(0)], nan)
+    fromPeripheral = initiationRegion == REGIONS.index('P')
+    fromCentral = initiationRegion == REGIONS.index('C')
+    near = where(fromPeripheral, timeAt(tjuncP), where(fromCentral, timeAt(tjuncC), nan))
+    other = where(fromPeripheral, timeAt(tjuncC), where(fromCentral, timeAt(tjuncP), nan))
+    farEnd = where(fromPeripheral, timeAt(endC), where(fromCentral, timeAt(endP), nan))
+    reachedJunction = isfinite(near)
+    crossed = reachedJunction & isfinite(farEnd)
+
+    soma = spikes['soma']
+    initiationTime = full(numFibers, nan)
+    initiationTime[started] = time[initiation[started]]
+    return {'initiation': where(started, initiation - offsets[:-1], -1), 'initiation_region': initiationRegion,
+            'initiation_position': initiationPosition, 'initiation_latency': initiationTime - delay,
+            'velocity': velocity, 'reached_junction': reachedJunction, 'crossed': crossed,
+            'junction_failure': reachedJunction & ~crossed, 'junction_delay': other - near,
+            'soma_invaded': isfinite(soma), 'soma_latency': soma - delay, 'invasion_time': soma - initiationTime}
@@ -0,0 +1,178 @@
+# Code to record the activity of the sensory neuron models: action potential times at chosen nodes, and decimated traces of chosen compartments
+
+from __future__ import division
+from neuron_runtime import h
+from numpy import arange,argsort,array,concatenate,isin,nan,repeat
+
+from functools import partial
+
+# named nodes (and the soma) of ABetaFiber/ADeltaFiber, see the end of _construct_cell
+LANDMARKS = ('endP', 'midPeripheral', 'TjuncP', 'TjuncStem', 'TjuncC', 'midCentral', 'endC', 'soma')
+
+# compartment types of the axons, see Cell._internodes
+COMPARTMENTS = ('node', 'MYSA', 'FLUT', 'STIN')
+
+def compartment_sections(cell, compartments=COMPARTMENTS, regions=('P', 'T', 'C')):
+    '''
+    Names and sections of a selection of compartments of the cell, in the order of its compartment table (see
+    Cell.get_compartment_table)
+    compartments: types to select, from COMPARTMENTS plus 'iseg' and 'soma'
+    regions: axons to select, 'P', 'T' and/or 'C'
+    returns a list of names (e.g. 'STINP[12]', 'STINCvar[3]', 'soma') and a list of sections
+    '''
+    for compartment in compartments:
+        if compartment not in COMPARTMENTS+('iseg', 'soma'): raise ValueError('Unknown compartment type %s, choose from %s, iseg or soma!!!' % (compartment, ', '.join(COMPARTMENTS)))
+    table = cell.get_compartment_table()
+    selected = isin(table['type'], compartments) & (isin(table['region'], regions) | ~isin(table['region'], ['P', 'T', 'C']))
+    return table['name'][selected].tolist(), table['sec'][selected].tolist()
+
+def node_sections(cell, nodes='landmarks'):
+    '''
+    Names and sections of a selection of nodes of the cell
+    nodes: 'landmarks' (see LANDMARKS), 'all' (every node of the peripheral, stem and central axon), 'propagation'
+        (every node and the soma, see Propagation.fiber_spikes), a region 'P', 'T' or 'C' (every node of that axon),
+        or a list of landmark names
+    returns a list of names and a list of sections
+    '''
+    if nodes in ('all', 'propagation'):
+        regions = ('P', 'T', 'C')
+    elif nodes in ('P', 'T', 'C'):
+        regions = (nodes,)
+    else:
+        regions = ()
+    if regions:
+        names, sections = [], []
+        for region in regions:
+            for ii in range(getattr(cell, 'axonnodes'+region)):
+                names.append('node%s[%i]' % (region, ii))
+                sections.append(getattr(cell.hocCell, 'node'+region)[ii])
+        if nodes == 'propagation':
+            names.append('soma')
+            sections.append(cell.soma)
+        return names, sections
+
+    names = list(LANDMARKS if nodes == 'landmarks' else nodes)
+    for name in names:
+        if name not in LANDMARKS: raise ValueError('Unknown node %s, choose from %s!!!' % (name, ', '.join(LANDMARKS)))
+    return names, [getattr(cell, name) for name in names]
+
+class SpikeRecorder(object):
+    '''
+    Action potential times at a selection of nodes of a cell, detected by NetCon threshold crossings of v in the
+    middle of each node. Nothing is recorded per time step: each detector only appends its crossing times to a
+    Vector, which NEURON clears at every finitialize.
+
+    nodes: see node_sections
+    threshold: mV
+    stop_at: name of a recorded node, end the run as soon as an action potential reaches it
+    '''
+    def __init__(self, cell, nodes='landmarks', threshold=-20, stop_at=None):
+        self.names, self.sections = node_sections(cell, nodes)
+        self.index = dict((name, ii) for ii, name in enumerate(self.names))
+        if (stop_at is not None) and (stop_at not in self.index): raise ValueError('Can only stop at a recorded node, not %s!!!' % stop_at)
+
+        # one detector and one Vector of crossing times per node
+        self.vectors, self.netcons = [], []
+        for name, sec in zip(self.names, self.sections):
+            nc = h.NetCon(sec(0.5)._ref_v, None, sec=sec)
+            nc.threshold = threshold
+            self.vectors.append(h.Vector())
+            if name == stop_at:
+                self._stop = _StopRun(self.vectors[-1])
+                nc.record(self._stop.detected)
+            else:
+                nc.record(self.vectors[-1])
+            self.netcons.append(nc)
+        self.stop_at = stop_at
+
+    def spikes(self):
+        '''
+        returns the action potential times (ms) at all recorded nodes in time order, and the index of the node (in
+        names) of each
+        '''
+        times = concatenate([vec.as_numpy() for vec in self.vectors])
+        ids = repeat(arange(len(self.vectors)), self.counts())
+        order = argsort(times, kind='stable')
+        return times[order], ids[order]
+
+    def spike_times(self, name):
+        '''
+        returns the action potential times (ms) at one recorded node
+        '''
+        return self.vectors[self.index[name]].as_numpy().copy()
+
+    def first_spikes(self):
+        '''
+        returns the time (ms) of the first action potential at every recorded node, nan where there was none
+        '''
+        return array([vec.x[0] if vec.size() else nan for vec in self.vectors])
+
+    def counts(self):
+        '''
+        returns the number of action potentials at every recorded node
+        '''
+        return array([int(vec.size()) for vec in self.vectors])
+
+class _StopRun(object):
+    # records the action potential times at a node into times and ends the run at the first one; the one detector of
+    # the node does both, as NEURON can crash once several detectors of the same node, one of them stopping the
+    # run, are freed
+    def __init__(self, times):
+        self.times = times
+        # cleared at every finitialize like the Vectors of NetCon.record
+        self.handler = h.FInitializeHandler(0, partial(times.resize, 0))
+
+    def detected(self):
+        self.times.append(h.t)
+        h.stoprun = 1
+
+class TraceRecorder(object):
+    '''
+    Traces of a variable (v by default) in the middle of a selection of compartments, sampled every interval ms
+    rather than every time step. The Vectors are preallocated for a run of tstop ms, so they are never reallocated
+    while recording, and traces() hands them out as NumPy views without copying.
+
+    tstop, interval: ms
+    sections: sections to record from, e.g. cell.get_secs_in_order(); by default every compartment selected by
+        compartment_sections(cell, compartments, regions)
+    variable: range variable to record, e.g. 'v' or 'e_extracellular'
+    '''
+    def __init__(self, cell, tstop, interval=0.1, sections=None, compartments=COMPARTMENTS, regions=('P', 'T', 'C'), variable='v'):
+        if sections is None:
+            self.names, self.sections = compartment_sections(cell, compartments, regions)
+        else:
+            self.sections = list(sections)
+            self.names = [sec.name().split('.')[-1] for sec in self.sections]
+        self.interval = interval
+        self.samples = int(round(tstop/interval))+1
+        self.vectors = []
+        for sec in self.sections:
+            vec = h.Vector()
+            vec.buffer_size(self.samples+1)
+            vec.record(getattr(sec(0.5), '_ref_'+variable), interval)
+            self.vectors.append(vec)
+
+    def times(self):
+        '''
+        returns the sample times (ms) of the last run
+        '''
+        return arange(len(self.vectors[0]) if self.vectors else 0)*self.interval
+
+    def traces(self):
+        '''
+        returns one array per compartment, in the order of names. These are views of the recording Vectors: the
+        next run overwrites them, copy them to keep them.
+        '''
+        return [vec.as_numpy() for vec in self.vectors]
+
+    def trace(self, name):
+        '''
+        returns the trace of one recorded compartment (a view, see traces)
+        '''
+        return self.vectors[self.names.index(name)].as_numpy()
+
+    def array(self):
+        '''
+        returns a copy of all traces as a (compartments, samples) array
+        '''
+        return array(self.traces())
@@ -0,0 +1,113 @@
+# Code to stream the results of long stimulation sweeps to disk in columnar chunks, readable while the sweep runs and resumable after a crash
+
+from __future__ import division
+from numpy import concatenate,empty,isnan,load,nan,savez
+
+import os
+import re
+import tempfile
+
+# columns of ResultStore, with the value of a field a result does not have
+RESULT_COLUMNS = [('fiber', int, -1), ('fiber_type', 'U8', ''), ('fiberD', float, nan), ('amplitude', float, nan),
+                  ('pulse_width', float, nan), ('electrode', (float, 3), nan), ('activated', bool, False),
+                  ('threshold', float, nan), ('latencyC', float, nan), ('latencyP', float, nan),
+                  ('spikesC', float, nan), ('spikesP', float, nan), ('screened', bool, False)]
+
+def job_key(fiber, amplitude, pulse_width, electrode):
+    '''
+    Hashable identity of a (fiber index, amplitude, pulse width, electrode) job, nan fields (e.g. the amplitude of a
+    threshold search) compare equal
+    '''
+    values = (float(amplitude), float(pulse_width)) + tuple(float(value) for value in electrode)
+    return (int(fiber),) + tuple(None if isnan(value) else value for value in values)
+
+class ResultStore(object):
+    '''
+    Append-only results of a sweep in a directory of chunks, one .npz file of RESULT_COLUMNS per chunk_size
+    results. At most chunk_size results are held in memory; each full chunk is written under a temporary name and
+    renamed, so readers (load, in this or any other process) only ever see whole chunks, also while the sweep is
+    running. Reopening the directory continues after its last chunk, and pending() leaves out the jobs it holds, so
+    a restarted sweep only runs the rest. One process writes to a store at a time.
+
+    A result is a dictionary as returned by Simulation.simulate (plus fiber, fiber_type and fiberD, see run_sweep)
+    or holding a threshold; fields it does not have are stored as nan, -1, '' or False.
+    '''
+    def __init__(self, directory, chunk_size=1000):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.buffer = []
+        self.numChunks = len(self.chunks())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.flush()
+
+    def chunks(self):
+        '''
+        Paths of the complete chunks, in the order they were written
+        '''
+        return [os.path.join(self.directory, name) for name in sorted(os.listdir(self.directory)) if re.match(r'chunk_\d+\.npz$', name)]
+
+    def append(self, result):
+        '''
+        Add one result, writing a chunk once chunk_size results are held
+        '''
+        self.buffer.append(result)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def extend(self, results):
+        for result in results:
+            self.append(result)
+
+    def flush(self):
+        '''
+        Write the results held in memory as a chunk
+        '''
+        if not self.buffer:
+            return
+        table = empty(len(self.buffer), dtype=[column[:2] for column in RESULT_COLUMNS])
+        for name, dtype, missing in RESULT_COLUMNS:
+            table[name] = [result.get(name, missing) for result in self.buffer]
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as output:
+            savez(output, **dict((name, table[name]) for name in table.dtype.names))
+        os.replace(temporary, os.path.join(self.directory, 'chunk_%08i.npz' % self.numChunks))
+        self.numChunks += 1
+        self.buffer = []
+
+    def load(self, columns=None):
+        '''
+        Every result written so far (not those still held in memory, see flush)
+        columns: names of the columns to read, all RESULT_COLUMNS by default
+        returns a dictionary of one array per column
+        '''
+        names = [column[0] for column in RESULT_COLUMNS] if columns is None else list(columns)
+        parts = dict((name, []) for name in names)
+        for path in self.chunks():
+            with load(path) as chunk:
+                for name in names:
+                    parts[name].append(chunk[name])
+        nothing = empty(0, dtype=[column[:2] for column in RESULT_COLUMNS])
+        return dict((name, concatenate(parts[name]) if parts[name] else nothing[name].copy()) for name in names)
+
+    def completed(self):
+        '''
+        Keys (see job_key) of the jobs with a result in the store, written or held in memory
+        '''
+        stored = self.load(['fiber', 'amplitude', 'pulse_width', 'electrode'])
+        keys = set(job_key(*job) for job in zip(stored['fiber'], stored['amplitude'], stored['pulse_width'], stored['electrode']))
+        keys.update(job_key(result.get('fiber', -1), result.get('amplitude', nan), result.get('pulse_width', nan), result.get('electrode', (nan,)*3))
+                    for result in self.buffer)
+        return keys
+
+    def pending(self, jobs):
+        '''
+        The (fiber index, amplitude, pulse width, electrode) jobs without a result in the store, in their order
+        '''
+        completed = self.completed()
+        return [job for job in jobs if job_key(*job) not in completed]
@@ -0,0 +1,369 @@
+# Code to stimulate the sensory neuron models with an extracellular point source electrode, find activation thresholds and run stimulation sweeps in parallel
+
+from __future__ import division
+from neuron_runtime import h, load_mechanisms, running, warm_up
+from numpy import array,asarray,isfinite,isnan,maximum,nan,nanmax,nanmin,ones,zeros
+from Cell import ELECTRODE_DISTANCE, FINE_DISTANCE, ABetaFiber, ADeltaFiber
+from Extracellular import activating_function_peaks,point_source_stimulus
+from find_node_coordinates import find_devor_node_coordinates
+from Recording import SpikeRecorder
+
+from concurrent.futures import ProcessPoolExecutor
+import gc
+from itertools import product
+import multiprocessing
+import queue
+
+FIBER_CLASSES = {'ABeta': ABetaFiber, 'ADelta': ADeltaFiber}
+
+def build_fiber(fiber, cache=None):
+    '''
+    Build a fiber from its specification: the keyword arguments of ABetaFiber/ADeltaFiber plus
+    fiber_type, 'ABeta' or 'ADelta'
+    cache: BuildCache to restore the fiber from, or store it in
+    '''
+    arguments = dict(fiber)
+    fiber_type = arguments.pop('fiber_type', 'ABeta')
+    if fiber_type not in FIBER_CLASSES: raise ValueError('Unknown fiber type %s, choose from ABeta or ADelta!!!' % fiber_type)
+    if cache is not None:
+        return cache.build(FIBER_CLASSES[fiber_type], **arguments)
+    return FIBER_CLASSES[fiber_type](**arguments)
+
+def rectangular_pulse(pulse_width, delay=0.1, tstop=5):
+    '''
+    Monophasic rectangular pulse of unit amplitude, as (times (ms), values) to be played with linear interpolation
+    '''
+    return [0, delay, delay, delay+pulse_width, delay+pulse_width, tstop], [0, 0, 1, 1, 0, 0]
+
+def record_spikes(cell, amplitude, waveform, electrode, nodes='landmarks', tstop=5, dt=0.005, conductivity=0.2, threshold=-20, stop_at=None):
+    '''
+    Apply amplitude*waveform through a point source electrode and record the action potential times (ms) at a
+    selection of nodes, without recording any voltage traces.
+    amplitude: mA, negative for cathodic
+    waveform: (times (ms), normalized values), e.g. from rectangular_pulse
+    nodes: see Recording.node_sections
+    threshold: mV, action potential detection threshold
+    stop_at: name of a recorded node, end the run as soon as an action potential reaches it
+    The stimulus stays attached to the cell for the next run (see Extracellular.point_source_stimulus) until another
+    stimulus is played or it is stopped.
+    returns the SpikeRecorder
+    '''
+    stimulus = point_source_stimulus(cell, electrode, conductivity)
+    stimulus.set_waveform(waveform)
+    stimulus.set_amplitude(amplitude)
+    stimulus.play()
+
+    recorder = SpikeRecorder(cell, nodes, threshold, stop_at)
+    h.dt = dt
+    cell.initialize()
+    with cell.profile_phase('run'):
+        h.continuerun(tstop)
+    return recorder
+
+def simulate_waveform(cell, amplitude, waveform, electrode, stop_at=None, **options):
+    '''
+    Apply amplitude*waveform through a point source electrode and record the action potential times (ms) at the
+    central (endC) and peripheral (endP) ends of the fiber.
+    stop_at: 'endC' or 'endP', end the run as soon as an action potential reaches that end
+    options: passed on to record_spikes
+    returns arrays of the action potential times at endC and at endP
+    '''
+    recorder = record_spikes(cell, amplitude, waveform, electrode, nodes=['endC', 'endP'], stop_at=stop_at, **options)
+    return recorder.spike_times('endC'), recorder.spike_times('endP')
+
+def simulate(cell, amplitude, pulse_width, electrode, delay=0.1, tstop=5, **options):
+    '''
+    Apply one monophasic rectangular pulse through a point source electrode and detect action potentials at the
+    central (endC) and peripheral (endP) ends of the fiber.
+    amplitude: mA, negative for cathodic
+    pulse_width, delay, tstop: ms
+    options: passed on to simulate_waveform
+    '''
+    spikesC, spikesP = simulate_waveform(cell, amplitude, rectangular_pulse(pulse_width, delay, tstop), electrode, tstop=tstop, **options)
+
+    return {'amplitude': amplitude, 'pulse_width': pulse_width, 'electrode': tuple(electrode),
+            'activated': len(spikesC) > 0,
+            'latencyC': spikesC[0]-delay if len(spikesC) else nan,
+            'latencyP': spikesP[0]-delay if len(spikesP) else nan,
+            'spikesC': len(spikesC), 'spikesP': len(spikesP)}
+
+def find_threshold(cell, waveform, electrode, guess=None, precision=0.01, polarity=-1, bracket=0.1, detect_at='endC', max_amplitude=100., **options):
+    '''
+    Smallest stimulus amplitude (mA) that evokes an action potential at endC (or endP, see detect_at), found by bisection.
+    Every run ends as soon as the action potential is detected.
+
+    guess: threshold of a similar fiber or a nearby electrode position. The search starts from the bracket
+        guess*(1-bracket) .. guess*(1+bracket) and only widens it if the threshold lies outside, which usually takes
+        far fewer runs than bisecting from scratch. Without a guess (or with a guess of 0, inf or nan) the bracket is found
+        by doubling from 1 uA.
+    precision: relative width of the final bracket
+    polarity: -1 for cathodic, 1 for anodic stimulation, ignored when a guess is given
+    options: passed on to simulate_waveform
+    returns the threshold (signed, mA, nan if max_amplitude does not activate the fiber) and the number of runs
+    '''
+    if (guess is not None) and not (isfinite(guess) and (guess != 0)):
+        guess = None
+    if guess is not None:
+        polarity = -1 if guess < 0 else 1
+    runs = [0]
+    def activates(magnitude):
+        runs[0] += 1
+        spikesC, spikesP = simulate_waveform(cell, polarity*magnitude, waveform, electrode, stop_at=detect_at, **options)
+        return len(spikesC if detect_at == 'endC' else spikesP) > 0
+
+    # bracket the threshold: low does not activate the fiber, high does
+    if guess is not None:
+        low, high = abs(guess)*(1-bracket), abs(guess)*(1+bracket)
+    else:
+        low, high = 0., 1e-3
+    if activates(high):
+        while (low > 0) and activates(low):
+            high, low = low, low*(1-bracket)/(1+bracket)
+    else:
+        low = high
+        while True:
+            high = high*(1+bracket)/(1-bracket) if guess is not None else high*2
+            if high > max_amplitude:
+                return nan, runs[0]
+            if activates(high):
+                break
+            low = high
+
+    while (high-low) > precision*high:
+        middle = (low+high)/2
+        if activates(middle):
+            high = middle
+        else:
+            low = middle
+
+    return polarity*high, runs[0]
+
+def find_thresholds(cells, waveform, electrodes, **options):
+    '''
+    Thresholds of every cell at every electrode position. Each search is warm started from the previous threshold:
+    the previous electrode position of the same cell, or the first electrode position of the previous cell.
+    options: passed on to find_threshold
+    returns a (cells, electrodes) array of thresholds (mA) and the total number of runs
+    '''
+    thresholds = nan*ones((len(cells), len(electrodes)))
+    totalRuns = 0
+    guess = options.pop('guess', None)
+    for ii, cell in enumerate(cells):
+        for jj, electrode in enumerate(electrodes):
+            if jj > 0 and not isnan(thresholds[ii,jj-1]):
+                guess = thresholds[ii,jj-1]
+            elif jj == 0 and ii > 0 and not isnan(thresholds[ii-1,0]):
+                guess = thresholds[ii-1,0]
+            thresholds[ii,jj], runs = find_threshold(cell, waveform, electrode, guess=guess, **options)
+            totalRuns += runs
+    return thresholds, totalRuns
+
+def coarsening_error(fiber, waveform, electrodes, fine_distance=FINE_DISTANCE, electrode_distance=ELECTRODE_DISTANCE, **options):
+    '''
+    Threshold error of the variable_STIN discretization against the fully resolved fiber. For every electrode
+    position the coarse fiber keeps full resolution within fine_distance of the T-junction and up to the last node
+    within electrode_distance of the electrode (m), see Cell.fine_internodes; both default to what a fiber is built
+    with.
+    fiber: fiber specification, see build_fiber
+    options: passed on to find_threshold
+    returns the thresholds (mA) of the full and the coarse fiber, their relative difference, and the number of
+    sections of the full and the coarse fiber, one entry per electrode position
+    '''
+    full = build_fiber(dict(fiber, variable_STIN=False))
+    fullSections = len(full.get_secs())
+    thresholds = find_thresholds([full], waveform, electrodes, **options)[0]
+    del full
+    gc.collect() # the fiber and its stimulus refer to each other
+
+    coarse, coarseSections = nan*ones(len(electrodes)), zeros(len(electrodes), dtype=int)
+    for ii, electrode in enumerate(electrodes):
+        cell = build_fiber(dict(fiber, variable_STIN=True, fine_distance=fine_distance, electrode=tuple(electrode), electrode_distance=electrode_distance))
+        coarseSections[ii] = len(cell.get_secs())
+        guess = None if isnan(thresholds[0,ii]) else thresholds[0,ii]
+        coarse[ii] = find_threshold(cell, waveform, electrode, guess=guess, **options)[0]
+        del cell
+        gc.collect()
+    return {'full': thresholds[0], 'coarse': coarse, 'error': (coarse-thresholds[0])/thresholds[0],
+            'full_sections': fullSections, 'coarse_sections': coarseSections}
+
+def fiber_node_paths(fiber):
+    '''
+    Node coordinates (m) of the peripheral, stem and central axon of a fiber specification (see build_fiber), placed
+    like the fiber would place them but without building it
+    '''
+    arguments = dict(fiber)
+    fiberClass = FIBER_CLASSES[arguments.get('fiber_type', 'ABeta')]
+    interpolate = arguments.get('interpolate_diameter', False)
+    if 'node_coordinates' in arguments:
+        (dorsal, dxDorsal), (peripheral, dxPeripheral) = arguments['node_coordinates']
+    else:
+        dorsal = find_devor_node_coordinates(arguments['dorsal_trajectory'], 'dorsal', 'hybrid', arguments['fiberD_central'], interpolate)[0]
+        peripheral = find_devor_node_coordinates(arguments['peripheral_trajectory'], 'peripheral', 'hybrid', arguments['fiberD_peripheral'], interpolate)[0]
+    stem = find_devor_node_coordinates(arguments['stem_trajectory'], fiberClass.STEM_AXON, 'hybrid', arguments['fiberD_stem'], interpolate)[0]
+    return [array(peripheral, dtype=float), array(stem[:fiberClass.STEM_NODES], dtype=float), array(dorsal, dtype=float)]
+
+def peak_activating_function(peaks, amplitudes):
+    '''
+    Peak activating function (mV/mm^2) driven by each amplitude
+    peaks: largest and smallest activating function per mA, (fibers, electrodes) arrays from
+        Extracellular.activating_function_peaks
+    amplitudes: mA, signed
+    returns a (fibers, electrodes, amplitudes) array
+    '''
+    largest, smallest = peaks
+    amplitudes = asarray(amplitudes, dtype=float)
+    return maximum(largest[:,:,None]*amplitudes, smallest[:,:,None]*amplitudes)
+
+def calibrate_screen(peaks, thresholds, margin=1.5):
+    '''
+    Activating function bounds of a pre-screen (see screen) from thresholds simulated for the same kind of fibers
+    and pulse width, e.g. with find_thresholds for a sample of fibers and electrode positions
+    peaks: from Extracellular.activating_function_peaks, for the fibers and electrode positions of thresholds
+    thresholds: (fibers, electrodes) signed thresholds (mA)
+    margin: factor by which the bounds are widened beyond the activating function at the simulated thresholds
+    returns the peak activating function (mV/mm^2) below which no fiber is taken to be activated, and the one above
+        which every fiber is
+    '''
+    thresholds = asarray(thresholds, dtype=float)
+    atThreshold = maximum(peaks[0]*thresholds, peaks[1]*thresholds)
+    return nanmin(atThreshold)/margin, nanmax(atThreshold)*margin
+
+def screen(peaks, amplitudes, bounds):
+    '''
+    Classify stimuli by the peak activating function they drive, without simulating them
+    peaks: from Extracellular.activating_function_peaks
+    amplitudes: mA, signed
+    bounds: from calibrate_screen
+    returns a (fibers, electrodes, amplitudes) array: -1 certainly not activated, 1 certainly activated, 0 to be
+        simulated
+    '''
+    af = peak_activating_function(peaks, amplitudes)
+    classes = zeros(af.shape, dtype=int)
+    classes[af < bounds[0]] = -1
+    classes[af > bounds[1]] = 1
+    return classes
+
+def grid_jobs(numFibers, amplitudes, pulse_widths, electrodes):
+    '''
+    Every combination of fiber, amplitude, pulse width and electrode position, ordered by fiber
+    '''
+    return list(product(range(numFibers), amplitudes, pulse_widths, [tuple(electrode) for electrode in electrodes]))
+
+def screen_jobs(jobs, peaks, electrodes, bounds):
+    '''
+    Split (fiber, amplitude, pulse width, electrode) jobs into those the pre-screen decides and those that still
+    need to be simulated
+    jobs: e.g. from grid_jobs
+    peaks: from Extracellular.activating_function_peaks, for the fibers and electrodes
+    bounds: from calibrate_screen, or a dictionary of them per pulse width; jobs of other pulse widths are simulated
+    returns the jobs to simulate and the results of the decided ones (like those of simulate, with nan latencies
+        and screened set)
+    '''
+    jobs = list(jobs)
+    if not isinstance(bounds, dict):
+        bounds = dict((pulse_width, bounds) for fiberIndex, amplitude, pulse_width, electrode in jobs)
+    electrodeIndex = dict((tuple(electrode), ii) for ii, electrode in enumerate(electrodes))
+
+    fiberIndices = array([job[0] for job in jobs], dtype=int)
+    electrodeIndices = array([electrodeIndex[tuple(job[3])] for job in jobs], dtype=int)
+    amplitudes = array([job[1] for job in jobs], dtype=float)
+    af = maximum(peaks[0][fiberIndices,electrodeIndices]*amplitudes, peaks[1][fiberIndices,electrodeIndices]*amplitudes)
+    low = array([bounds.get(job[2], (nan, nan))[0] for job in jobs])
+    high = array([bounds.get(job[2], (nan, nan))[1] for job in jobs])
+
+    simulated, screened = [], []
+    for job, notActivated, activated in zip(jobs, af < low, af > high):
+        fiberIndex, amplitude, pulse_width, electrode = job
+        if notActivated or activated:
+            screened.append({'amplitude': amplitude, 'pulse_width': pulse_width, 'electrode': tuple(electrode),
+                             'activated': bool(activated), 'latencyC': nan, 'latencyP': nan,
+                             'spikesC': nan, 'spikesP': nan, 'fiber': fiberIndex, 'screened': True})
+        else:
+            simulated.append(job)
+    return simulated, screened
+
+# state of a sweep worker process: the fiber specifications, the build cache, the one fiber currently built and the
+# queue its results go back to the sweep through
+_worker = {'fibers': None, 'cache': None, 'index': None, 'cell': None, 'results': None}
+
+def _init_worker(fibers, mechanism_dir, cache=None, warm=True, results=None):
+    # a forked worker inherits every section of the parent process, which would otherwise be simulated with each job
+    if running():
+        h('forall delete_section()')
+    # warm: start NEURON and load the templates of the sweep here, before the first job, rather than in it
+    if warm:
+        warm_up(set(fiber['CELL_DIR']+fiber['CELL_FILE_NAME'] for fiber in fibers), mechanism_dir)
+    elif mechanism_dir is not None:
+        load_mechanisms(mechanism_dir)
+    _worker['fibers'] = fibers
+    _worker['cache'] = cache
+    _worker['results'] = results
+
+def _run_jobs(fiberIndex, conditions, options, chunksize=None):
+    # every chunksize results (all results of the fiber at once without chunksize) are sent back through the results
+    # queue of the worker as they are done, and only their number is returned
+    # build the fiber only when the worker moves on to a new one; the previous one is freed so it is not simulated along
+    if _worker['index'] != fiberIndex:
+        _worker['cell'] = None
+        gc.collect()
+        _worker['cell'] = build_fiber(_worker['fibers'][fiberIndex], _worker['cache'])
+        _worker['index'] = fiberIndex
+    results = []
+    for ii, (amplitude, pulse_width, electrode) in enumerate(conditions):
+        result = simulate(_worker['cell'], amplitude, pulse_width, electrode, **options)
+        result['fiber'] = fiberIndex
+        results.append(result)
+        if (len(results) == chunksize) or (ii == len(conditions)-1):
+            _worker['results'].put(results)
+            results = []
+    return len(conditions)
+
+def run_sweep(fibers, jobs, processes=None, chunksize=16, mechanism_dir=None, mp_context=None, cache=None, warm=True, store=None, **options):
+    '''
+    Run (fiber, amplitude, pulse width, electrode) jobs on a pool of worker processes, yielding each result as soon
+    as its chunk of jobs completes (not in job order).
+
+    fibers: list of fiber specifications, see build_fiber
+    jobs: iterable of (fiber index, amplitude, pulse_width, electrode), e.g. from grid_jobs
+    chunksize: results sent back by a worker at a time, None for all results of a fiber at once. All jobs of a fiber
+        go to one worker, which builds the fiber once and streams its results back in chunks while it works through them.
+    mechanism_dir: directory of the compiled mechanisms, loaded once per worker
+    cache: BuildCache shared by the workers, so each fiber is built and settled only once across sweeps
+    warm: have every worker start NEURON and load the cell templates as it starts, see neuron_runtime.warm_up
+    store: Results.ResultStore to stream the results to, with the fiber_type and fiberD (peripheral) of their fiber;
+        jobs it already holds, e.g. from a crashed run of the same sweep, are skipped
+    options: passed on to simulate
+    '''
+    if store is not None:
+        jobs = store.pending(jobs)
+    byFiber = {}
+    for fiberIndex, amplitude, pulse_width, electrode in jobs:
+        byFiber.setdefault(fiberIndex, []).append((amplitude, pulse_width, electrode))
+
+    numJobs = sum(len(conditions) for conditions in byFiber.values())
+    results = (mp_context or multiprocessing).Queue()
+    try:
+        with ProcessPoolExecutor(max_workers=processes, mp_context=mp_context, initializer=_init_worker, initargs=(fibers, mechanism_dir, cache, warm, results)) as pool:
+            # one task per fiber, largest first
+            futures = [pool.submit(_run_jobs, fiberIndex, byFiber[fiberIndex], options, chunksize)
+                       for fiberIndex in sorted(byFiber, key=lambda fiberIndex: -len(byFiber[fiberIndex]))]
+            received = 0
+            while received < numJobs:
+                try:
+                    chunk = results.get(timeout=1)
+                except queue.Empty:
+                    # a failed fiber never sends the rest of its results
+                    for future in futures:
+                        if future.done() and (future.exception() is not None):
+                            raise future.exception()
+                    continue
+                received += len(chunk)
+                for result in chunk:
+                    if store is not None:
+                        fiber = fibers[result['fiber']]
+                        store.append(dict(result, fiber_type=fiber.get('fiber_type', 'ABeta'), fiberD=fiber.get('fiberD_peripheral', nan)))
+                    yield result
+    finally:
+        # also when the sweep is abandoned or fails, so only a crash of this process loses what is held in memory
+        if store is not None:
+            store.flush()
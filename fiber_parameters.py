@@ -0,0 +1,77 @@
+# Code to look up the diameter dependent MRG geometry and electrical parameters of the myelinated axons, shared by find_node_coordinates.py, Cell.py and the hoc templates
+
+from __future__ import division
+from numpy import interp,pi
+
+# MRG (McIntyre, Richardson and Grill 2002) geometry per fiber diameter (um):
+# g ratio, axon, node, MYSA and FLUT diameters (um), node spacing deltax (um), FLUT length (um), number of myelin lamellae
+MRG_COLUMNS = ('g', 'axonD', 'nodeD', 'paraD1', 'paraD2', 'deltax', 'paralength2', 'nl')
+MRG_TABLE = {
+    2.0:  (None,  1.6,  1.4, 1.4,  1.6,  117, 10,  30),
+    3.0:  (None,  2.3,  1.6, 1.6,  2.3,  309, 21,  56),
+    5.7:  (0.605, 3.4,  1.9, 1.9,  3.4,  500, 35,  80),
+    7.3:  (0.630, 4.6,  2.4, 2.4,  4.6,  750, 38,  100),
+    8.7:  (0.661, 5.8,  2.8, 2.8,  5.8,  1000, 40, 110),
+    10.0: (0.690, 6.9,  3.3, 3.3,  6.9,  1150, 46, 120),
+    11.5: (0.700, 8.1,  3.7, 3.7,  8.1,  1250, 50, 130),
+    12.8: (0.719, 9.2,  4.2, 4.2,  9.2,  1350, 54, 135),
+    14.0: (0.739, 10.4, 4.7, 4.7,  10.4, 1400, 56, 140),
+    15.0: (0.767, 11.5, 5.0, 5.0,  11.5, 1450, 58, 145),
+    16.0: (0.791, 12.7, 5.5, 5.5,  12.7, 1500, 60, 150),
+}
+MRG_DIAMETERS = tuple(sorted(MRG_TABLE))
+
+# diameter independent parameters, same values as model_globels() in the hoc templates
+rhoa = 0.7e6 # Ohm-um
+space_p1 = 0.002 # um, periaxonal space of the node and MYSA
+space_p2 = 0.004 # um, periaxonal space of the FLUT
+space_i = 0.004 # um, periaxonal space of the STIN
+nodelength = 1.0 # um
+paralength1 = 3 # um, MYSA length
+mycm = 0.1 # uF/cm2/lamella membrane
+mygm = 0.001 # S/cm2/lamella membrane
+celsius = 37 # degC, set by Cell.initialize and Cell.settle rather than model_globels()
+
+# order in which the hoc templates read the parameters of each axon region in dependent_var()
+HOC_PARAMETERS = ('axonD', 'nodeD', 'paraD1', 'paraD2', 'deltax', 'paralength2', 'nl', 'Rpn0', 'Rpn1', 'Rpn2', 'Rpx', 'interlength')
+
+_parameters = {}
+
+def periaxonal_resistance(diameter, space):
+    '''
+    Periaxonal resistance (MOhm/cm) of a compartment of the given diameter (um) and periaxonal space (um)
+    '''
+    return (rhoa*.01)/(pi*((((diameter/2)+space)**2)-((diameter/2)**2)))
+
+def mrg_parameters(fiberD, interpolate=False):
+    '''
+    Geometry and periaxonal resistances of an MRG axon of diameter fiberD (um, rounded to 0.1 um like in the hoc
+    templates). Computed once per diameter; the returned dictionary is shared, do not modify it.
+
+    interpolate: linearly interpolate the geometry of diameters between the tabulated ones
+    '''
+    fiberD = round(float(fiberD), 1)
+    key = (fiberD, interpolate and (fiberD not in MRG_TABLE))
+    if key not in _parameters:
+        if fiberD in MRG_TABLE:
+            parameters = dict(zip(MRG_COLUMNS, MRG_TABLE[fiberD]))
+        elif interpolate and (MRG_DIAMETERS[0] < fiberD < MRG_DIAMETERS[-1]):
+            parameters = {}
+            for ii, column in enumerate(MRG_COLUMNS):
+                diameters = [fD for fD in MRG_DIAMETERS if MRG_TABLE[fD][ii] is not None]
+                if diameters[0] <= fiberD:
+                    parameters[column] = float(interp(fiberD, diameters, [MRG_TABLE[fD][ii] for fD in diameters]))
+                else:
+                    parameters[column] = None
+        else:
+            raise ValueError('Unsupported fiber diameter %g um, choose from %s or interpolate between them!!!' % (fiberD, ', '.join('%g' % fD for fD in MRG_DIAMETERS)))
+
+        parameters['fiberD'] = fiberD
+        parameters['Rpn0'] = periaxonal_resistance(parameters['nodeD'], space_p1)
+        parameters['Rpn1'] = periaxonal_resistance(parameters['paraD1'], space_p1)
+        parameters['Rpn2'] = periaxonal_resistance(parameters['paraD2'], space_p2)
+        parameters['Rpx'] = periaxonal_resistance(parameters['axonD'], space_i)
+        parameters['interlength'] = (parameters['deltax']-nodelength-(2*paralength1)-(2*parameters['paralength2']))/6
+        parameters['hoc'] = tuple(parameters[name] for name in HOC_PARAMETERS)
+        _parameters[key] = parameters
+    return _parameters[key]
@@ -1,23 +1,20 @@
 # Function to create node coordinates, called from Cell.py
 
 
-def find_devor_node_coordinates(axon_trajectory, axonName, axonType, fiberD):
+from fiber_parameters import mrg_parameters
+from numpy import absolute,arange,argmax,array,asarray,concatenate,cumsum,diff,flatnonzero,full,maximum,minimum,nan,ones,searchsorted,shape,sqrt,zeros
 
-    from numpy import array,sqrt,shape,sin,pi,ones,zeros,sqrt,multiply
+
+def internode_lengths(axon_trajectory, axonType, fiberD, interpolate=False):
+    '''
+    Internode lengths (m) of the dorsal and peripheral axons. The first three internodes next to the
+    t-junction are shortened following Ito and Takahashi 1960 / Amir and Devor 2003.
+    interpolate: allow diameters between the tabulated ones, see fiber_parameters.mrg_parameters
+    '''
 
     if axonType == 'hybrid':
-        # specify deltax (i.e. node spacing) based on fiber diameter, try to work into axon class
-        if (fiberD==2.0): deltax, nodeD, fiberD = 117, 1.4, 1.6
-        if (fiberD==3.0): deltax, nodeD, fiberD = 309, 1.6, 2.3
-        if (fiberD==5.7): deltax, nodeD, fiberD = 500, 1.9, 3.4
-        if (fiberD==7.3): deltax, nodeD, fiberD = 750, 2.4, 4.6
-        if (fiberD==8.7): deltax, nodeD, fiberD = 1000, 2.8, 5.8
-        if (fiberD==10.0): deltax, nodeD, fiberD = 1150, 3.3, 6.9
-        if (fiberD==11.5): deltax, nodeD, fiberD = 1250, 3.7, 8.1
-        if (fiberD==12.8): deltax, nodeD, fiberD = 1350, 4.2, 9.2
-        if (fiberD==14.0): deltax, nodeD, fiberD = 1400, 4.7, 10.4
-        if (fiberD==15.0): deltax, nodeD, fiberD = 1450, 5.0, 11.5
-        if (fiberD==16.0): deltax, nodeD, fiberD = 1500, 5.5, 12.7
+        # node spacing (um) based on fiber diameter, from the shared MRG table
+        deltax = mrg_parameters(fiberD, interpolate)['deltax']
 
         # ratios for normalizing variable node lengths based on "normal" internode lengths
         # from Amir and Devor 2003/Ito and Takahashi 1960
@@ -51,66 +48,125 @@ def find_devor_node_coordinates(axon_trajectory, axonName, axonType, fiberD):
         # starting from junction node, moving towards soma
         dxStem = [(1.5+201)*1e-6, (1.5+168)*1e-6, (1.5+130)*1e-6, (1.5+85)*1e-6]
 
-
-    ii, jj = 0, 0
-    count = 0
+    return dxDorsal, dxPeripheral
+
+
+def place_nodes_along_trajectories(axon_trajectories, internodeLengths):
+    '''
+    Vectorized node placement for a batch of trajectories.
+
+    All trajectories are walked in lockstep, one node per step. The cumulative arc length of the batch is
+    computed once, and since a chord is never longer than the arc it spans, searchsorted on it skips every
+    trajectory point that cannot hold the next node; only a short window of points past that is tested.
+    The node itself is interpolated with the same arithmetic as the original point-by-point walk, so the
+    coordinates are identical to it.
+
+    axon_trajectories: list of (n,3) arrays (m)
+    internodeLengths: one row per trajectory, holding the lengths of the internodes following nodes 0,1,2,...;
+        the last column is used for every remaining internode
+    returns a list of (nodes,3) arrays of node coordinates
+    '''
+
+    axon_trajectories = [asarray(axon_trajectory, dtype=float) for axon_trajectory in axon_trajectories]
+    internodeLengths = asarray(internodeLengths, dtype=float)
+    numTrajectories = len(axon_trajectories)
+    numPoints = array([shape(axon_trajectory)[0] for axon_trajectory in axon_trajectories])
+    firstPoint = concatenate(([0], cumsum(numPoints)[:-1]))
+    lastPoint = firstPoint + numPoints - 1
+    points = concatenate(axon_trajectories, axis=0)
+
+    # cumulative arc length over the whole batch, monotonic so a single searchsorted serves all trajectories
+    steps = diff(points, axis=0)
+    arcLength = concatenate(([0.], cumsum(sqrt(steps[:,0]**2 + steps[:,1]**2 + steps[:,2]**2))))
+
+    trajectoryIds = arange(numTrajectories)
+    nodes = points[firstPoint].copy() # node each trajectory is currently on
+    segments = firstPoint.copy() # trajectory point starting the segment that node lies on, i.e. P0
+    active = numPoints > 1
+    placed = [nodes.copy()]
+    numNodes = ones(numTrajectories, dtype=int)
+    jj = 0
+    while active.any():
+        dx = internodeLengths[:, min(jj, shape(internodeLengths)[1]-1)]
+        ids = trajectoryIds[active]
+        P, dx, P0 = nodes[ids], dx[ids], segments[ids]
+
+        # skip the points that are within one internode of arc length of the current node
+        PP0 = P - points[P0]
+        arcP = arcLength[P0] + sqrt(PP0[:,0]**2 + PP0[:,1]**2 + PP0[:,2]**2)
+        start = maximum(searchsorted(arcLength, arcP + dx, side='left') - 1, P0 + 1)
+
+        # first point further away than one internode, -1 if the trajectory ends before that
+        hit = full(len(ids), -1)
+        searching = ones(len(ids), dtype=bool)
+        window = 16
+        while searching.any():
+            ss = flatnonzero(searching)
+            candidates = start[ss,None] + arange(window)
+            inside = candidates <= lastPoint[ids[ss],None]
+            candidates = minimum(candidates, lastPoint[ids[ss],None])
+            PP1 = points[candidates] - P[ss,None,:]
+            PP1 = sqrt(PP1[...,0]**2 + PP1[...,1]**2 + PP1[...,2]**2)
+            further = (PP1 > dx[ss,None]) & inside
+            found = further.any(axis=1)
+            hit[ss[found]] = candidates[found, argmax(further[found], axis=1)]
+            searching[ss[found | ~inside[:,-1]]] = False
+            start[ss] += window
+            window *= 2
+
+        active[ids[hit < 0]] = False
+        keep = hit >= 0
+        ids, P, dx, P1 = ids[keep], P[keep], dx[keep], hit[keep]
+        PP1 = points[P1] - P
+        PP1 = sqrt(PP1[:,0]**2 + PP1[:,1]**2 + PP1[:,2]**2)
+        P0P1 = points[P1] - points[P1-1]
+        P0P1 = sqrt(P0P1[:,0]**2 + P0P1[:,1]**2 + P0P1[:,2]**2)
+        tt = ((P0P1-PP1+dx)/P0P1)[:,None]
+        nodes[ids] = (1-tt)*points[P1-1] + tt*points[P1]
+        segments[ids] = P1-1
+        numNodes[ids] += 1
+
+        step = full((numTrajectories,3), nan)
+        step[ids] = nodes[ids]
+        placed.append(step)
+        jj += 1
+
+    placed = array(placed)
+    return [placed[:numNodes[ii],ii,:] for ii in range(numTrajectories)]
+
+
+def find_devor_node_coordinates_batch(axon_trajectories, axonName, axonType, fiberD, interpolate=False):
+    '''
+    find_devor_node_coordinates for a list of trajectories. fiberD is either one diameter for the whole batch
+    or one per trajectory. Dorsal and peripheral axons of the whole batch are placed in one pass.
+    returns a list of node coordinates and a list of internode lengths, one entry per trajectory
+    '''
+
+    if shape(fiberD) == ():
+        fiberD = [fiberD]*len(axon_trajectories)
+
+    if axonName not in ('dorsal', 'peripheral'):
+        coordinates = [find_devor_node_coordinates(axon_trajectory, axonName, axonType, fD, interpolate) for axon_trajectory, fD in zip(axon_trajectories, fiberD)]
+        return [cc[0] for cc in coordinates], [cc[1] for cc in coordinates]
+
+    dxs = [internode_lengths(axon_trajectory, axonType, fD, interpolate)[axonName == 'peripheral'] for axon_trajectory, fD in zip(axon_trajectories, fiberD)]
+    spacing = array([dx[[min(ii, len(dx)-1) for ii in range(4)]] for dx in dxs])
+
+    return place_nodes_along_trajectories(axon_trajectories, spacing), dxs
+
+
+def find_devor_node_coordinates(axon_trajectory, axonName, axonType, fiberD, interpolate=False):
+
+    if (axonName == 'dorsal') or (axonName == 'peripheral'):
+        NODE_COORDINATES, dx = find_devor_node_coordinates_batch([axon_trajectory], axonName, axonType, fiberD, interpolate)
+        return NODE_COORDINATES[0], dx[0]
+
+    ii = 0
     xx,yy,zz = list(), list(), list()
     P0 = axon_trajectory[ii,:]
-    P1 = axon_trajectory[ii+1,:]
     xx.append(P0[0]); yy.append(P0[1]); zz.append(P0[2]) #define initial point of axon, i.e. first node
-    zval = zz[0]
-    if (axonName == 'dorsal'):
-        while True:
-            P = [xx[jj],yy[jj],zz[jj]] # node you're currently on
-            PP1 = sqrt(sum((P1-P)**2)) # distance between current node and next point on trajectory
-
-            # if you're on one of the first 3 nodes, your internode length is variable
-            if jj <= 2:
-                dx = dxDorsal[jj]
-            else:
-                dx = dxDorsal[3]
-
-            if (PP1 > dx): # if the distance between current node and next point is greater than internode length
-                P0P1 = sqrt(sum((P1-P0)**2)) # calculate distance between 
-                tt = (P0P1-PP1+dx)/P0P1
-                xx.append((1-tt)*P0[0]+tt*P1[0])
-                yy.append((1-tt)*P0[1]+tt*P1[1])
-                zz.append((1-tt)*P0[2]+tt*P1[2])
-                jj+=1
-            else:
-                ii+=1                               #update P0 and P1
-                if (ii == (shape(axon_trajectory)[0]-1)):
-                    break
-                P0 = P1
-                P1 = axon_trajectory[ii+1,:]
-        dxForReturn = dxDorsal
-
-    elif (axonName == 'peripheral'):
-        while True:
-            P = [xx[jj],yy[jj],zz[jj]]
-            PP1 = sqrt(sum((P1-P)**2))
-
-            if jj <= 2:
-                dx = dxPeripheral[jj]
-            else:
-                dx = dxPeripheral[3]
-
-            if (PP1 > dx):
-                P0P1 = sqrt(sum((P1-P0)**2))
-                tt = (P0P1-PP1+dx)/P0P1
-                xx.append((1-tt)*P0[0]+tt*P1[0])
-                yy.append((1-tt)*P0[1]+tt*P1[1])
-                zz.append((1-tt)*P0[2]+tt*P1[2])
-                jj+=1
-            else:
-                ii+=1                               #update P0 and P1
-                if (ii == (shape(axon_trajectory)[0]-1)):
-                    break
-                P0 = P1
-                P1 = axon_trajectory[ii+1,:]
-        dxForReturn = dxPeripheral
-                
-    elif (axonName == 'stem'): # note this is only for the cell model from Amir and Devor 2003
+
+    if (axonName == 'stem'): # note this is only for the cell model from Amir and Devor 2003
         '''
         Explicitly defined stem axon
         '''
@@ -147,8 +203,6 @@ def find_devor_node_coordinates(axon_trajectory, axonName, axonType, fiberD):
         zz.append(zz[0])
 
     elif (axonName == 'stemMRG'):
-        from numpy import absolute
-
         xCoord = P0[0] + 1e-15
         yCoord = P0[1] + 1e-15
         zCoord = P0[2] + 1e-15
@@ -217,8 +271,6 @@ def find_devor_node_coordinates(axon_trajectory, axonName, axonType, fiberD):
         dxForReturn = None
 
     elif (axonName == 'stemMRG_adelta'):
-        from numpy import absolute
-
         xCoord = P0[0] + 1e-15
         yCoord = P0[1] + 1e-15
         zCoord = P0[2] + 1e-15
@@ -0,0 +1,77 @@
+# Code to start NEURON lazily: the runtime, the standard run library and the cell templates are loaded on first use, once per process
+
+import os
+import sys
+
+# the hoc interpreter once started, the templates loaded so far by file path and the mechanism directories still to load
+_runtime = {'h': None, 'templates': {}, 'mechanisms': []}
+
+def hoc():
+    '''
+    neuron.h, importing NEURON and loading stdrun.hoc and the mechanisms of load_mechanisms the first time
+    '''
+    if _runtime['h'] is None:
+        from neuron import h
+        h.load_file('stdrun.hoc')
+        _runtime['h'] = h
+    if _runtime['mechanisms']:
+        import neuron
+        while _runtime['mechanisms']:
+            neuron.load_mechanisms(_runtime['mechanisms'].pop(0))
+    return _runtime['h']
+
+def running():
+    '''
+    Whether NEURON was imported in this process, here or by other code, or in the process it was forked from
+    '''
+    return (_runtime['h'] is not None) or ('neuron' in sys.modules)
+
+class _LazyHoc(object):
+    # stands in for neuron.h in the modules of the models, so that importing them does not start NEURON
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        return getattr(hoc(), name)
+
+    def __setattr__(self, name, value):
+        setattr(hoc(), name, value)
+
+    def __call__(self, *args):
+        return hoc()(*args)
+
+h = _LazyHoc()
+
+def load_template(path):
+    '''
+    The cell template defined in the hoc file path (and named after it, e.g. ABetaFiber for ABetaFiber.hoc), loaded
+    once per process and kept for every later fiber
+    '''
+    template = _runtime['templates'].get(path)
+    if template is None:
+        hoc().load_file(path)
+        template = getattr(hoc(), os.path.splitext(os.path.basename(path))[0])
+        _runtime['templates'][path] = template
+    return template
+
+def load_mechanisms(mechanism_dir):
+    '''
+    Load the mechanisms compiled (nrnivmodl) in mechanism_dir, now if NEURON is started and with it otherwise
+    '''
+    _runtime['mechanisms'].append(mechanism_dir)
+    if _runtime['h'] is not None:
+        hoc()
+
+def neuron_version():
+    import neuron
+    return neuron.__version__
+
+def warm_up(templates=(), mechanism_dir=None):
+    '''
+    Start NEURON and load the standard run library, the mechanisms in mechanism_dir and the given template files
+    now rather than with the first fiber, e.g. as the initializer of worker processes
+    '''
+    if mechanism_dir is not None:
+        load_mechanisms(mechanism_dir)
+    hoc()
+    for path in templates:
+        load_template(path)